@@ -4,12 +4,21 @@
 FIXME/TODO: add usage/manual here.
 .. something about being able to contact multiple asterisken at the same time
 """
+import heapq
+import random
 import select
 import socket
 import sys
+import threading
 import time
+import traceback
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from hashlib import md5  # for challenge auth
 
+# Local friend package.
+from monamisink import make_sink
+
 
 class TokenBufferedSocket(object):
     """
@@ -28,6 +37,7 @@ class TokenBufferedSocket(object):
 
     All timeouts mentioned are in seconds (floats are legal).
     """
+    select_timeout = 0.333  # the default work() timeout
 
     def __init__(self, token=b'\n', on_data=None):
         """
@@ -39,11 +49,12 @@ class TokenBufferedSocket(object):
         assert token
         self._token = token  # e.g. LF or CRLF
         self._on_data = on_data
-        self._timeout = 0.333
+        self._timeout = self.select_timeout
         self._sock = None
         self._inbuf = b''
         self._outbuf = b''
         self._blocksize = 4096
+        self._last_recv = time.time()
 
         self._alarm_time = None
 
@@ -60,10 +71,20 @@ class TokenBufferedSocket(object):
         # Connect can raise:
         # s.error(), s.gaierror(), s.timeout(), OverflowError
         self._sock.connect((host, port))
+        self._last_recv = time.time()
         # This flag states that we should shut the connection down when we're
         # done writing.
         self._shutdown_when_written = False
 
+    def attach(self, sock):
+        """
+        Use an already connected socket, e.g. one returned by accept().
+        """
+        self._sock = sock
+        self._sock.setblocking(0)
+        self._last_recv = time.time()
+        self._shutdown_when_written = False
+
     def trace(self, message):
         """
         A way to debug this.
@@ -80,6 +101,18 @@ class TokenBufferedSocket(object):
         self._alarm_callback = callback
         self._alarm_time = time.time() + seconds
 
+    def cancel_alarm(self):
+        """
+        Remove the alarm, if any.
+        """
+        self._alarm_callback, self._alarm_time = None, None
+
+    def idle_time(self):
+        """
+        Return the amount of seconds since we last received data.
+        """
+        return time.time() - self._last_recv
+
     def loop(self, absolute_timeout=None, relative_timeout=None):
         """
         Main loop. Do all the work and exit when done.
@@ -100,9 +133,32 @@ class TokenBufferedSocket(object):
                     break
         self.abort()
 
-    def work(self):
+    def fileno(self):
+        """
+        Return the file descriptor of the socket, or None when we're not
+        connected. Useful if you want to select() on multiple sockets
+        yourself.
+        """
+        if not self._sock:
+            return None
+        return self._sock.fileno()
+
+    def has_output(self):
+        """
+        Return True if there is data waiting to be written.
+        """
+        return bool(self._outbuf)
+
+    def output_size(self):
+        """
+        Return the amount of bytes waiting to be written.
+        """
+        return len(self._outbuf or b'')
+
+    def work(self, timeout=None):
         """
-        Check if there is work to be done and do it.
+        Check if there is work to be done and do it. If timeout is None, the
+        default select timeout is used.
 
         We use select.select() here instead of poll() or newer candidates
         because we don't need anything fancy, and select is more portable.
@@ -115,7 +171,9 @@ class TokenBufferedSocket(object):
         if not self._sock:
             return None
 
-        rlist, wlist, timeout = [self._sock], [], self._timeout
+        if timeout is None:
+            timeout = self._timeout
+        rlist, wlist = [self._sock], []
         if self._outbuf:
             wlist.append(self._sock)
         rlist, wlist, xlist = select.select(rlist, wlist, (), timeout)
@@ -187,6 +245,7 @@ class TokenBufferedSocket(object):
                 self.trace('|| Recv yielded EOF\n')
                 self.abort()
             self.trace('<< %r (%d)\n' % (ret, len(ret)))
+            self._last_recv = time.time()
             # We could optimize things here by looking back at most
             # (len(token)-1) characters in _inbuf when looking for token. But
             # it doesn't feel worth while.
@@ -216,6 +275,107 @@ class TokenBufferedSocket(object):
             self.abort()
 
 
+def _timed_call(callback, args):
+    # Runs in the worker: time the callback only, not the time it spent
+    # waiting for a free worker.
+    t0 = time.time()
+    try:
+        callback(*args)
+    except Exception as e:
+        return time.time() - t0, e
+    return time.time() - t0, None
+
+
+class CallbackExecutor(object):
+    """
+    Run callbacks on a pool, so slow callbacks (database writes, ...) don't
+    stall the I/O loop. The callbacks are queued per key (e.g. per
+    connection): callbacks with the same key run one after another, in the
+    order in which they were submitted; callbacks with different keys run
+    in parallel.
+
+    By default a ThreadPoolExecutor with max_workers threads is used. You
+    can pass another concurrent.futures.Executor, like a
+    ProcessPoolExecutor, as long as the callbacks and their arguments can
+    be pickled.
+
+    Callbacks taking longer than slow_threshold seconds are reported to
+    on_slow(callback, seconds). Exceptions raised by callbacks are reported
+    to on_error(callback, exception). Both write to stderr by default.
+    """
+    def __init__(self, max_workers=4, slow_threshold=None, executor=None):
+        self.slow_threshold = slow_threshold
+        self._executor = executor or ThreadPoolExecutor(max_workers)
+        self._lock = threading.Condition()
+        self._queues = {}  # key => deque of waiting (callback, args)
+
+    def on_slow(self, callback, seconds):
+        sys.stderr.write('monami: slow callback %r took %.3fs\n' % (
+            callback, seconds))
+
+    def on_error(self, callback, exception):
+        sys.stderr.write('monami: callback %r raised:\n%s' % (
+            callback, ''.join(traceback.format_exception(
+                type(exception), exception, exception.__traceback__))))
+
+    def submit(self, key, callback, *args):
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append((callback, args))
+                return
+            self._queues[key] = deque()
+        self._start(key, callback, args)
+
+    def wait(self, timeout=None):
+        """
+        Wait until all submitted callbacks are done. Returns False on
+        timeout.
+        """
+        with self._lock:
+            return self._lock.wait_for(lambda: not self._queues, timeout)
+
+    def shutdown(self):
+        self.wait()
+        self._executor.shutdown()
+
+    def _start(self, key, callback, args):
+        # Loop instead of recursing when the callback finished before we
+        # could add the done callback.
+        while callback:
+            future = self._executor.submit(_timed_call, callback, args)
+            if not future.done():
+                future.add_done_callback(
+                    lambda future, callback=callback: self._on_done(
+                        key, callback, future))
+                return
+            callback, args = self._finish(key, callback, future)
+
+    def _on_done(self, key, callback, future):
+        callback, args = self._finish(key, callback, future)
+        if callback:
+            self._start(key, callback, args)
+
+    def _finish(self, key, callback, future):
+        if future.exception():
+            # Not the callback, but the submission failed (unpicklable).
+            self.on_error(callback, future.exception())
+        else:
+            seconds, exception = future.result()
+            if (self.slow_threshold is not None and
+                    seconds > self.slow_threshold):
+                self.on_slow(callback, seconds)
+            if exception:
+                self.on_error(callback, exception)
+        with self._lock:
+            queue = self._queues[key]
+            if queue:
+                return queue.popleft()
+            del self._queues[key]
+            self._lock.notify_all()
+        return None, None
+
+
 class MonAmiException(Exception):
     pass
 
@@ -260,30 +420,186 @@ class MonAmiTimeout(MonAmiException):
     pass
 
 
+# Manager event categories (the read= classes in manager.conf) of the more
+# common events. Used to derive the Events: mask from the events a client is
+# interested in.
+EVENT_CATEGORIES = {
+    'agent': (
+        'AgentCalled', 'AgentComplete', 'AgentConnect', 'AgentDump',
+        'AgentRingNoAnswer', 'QueueCallerAbandon', 'QueueCallerJoin',
+        'QueueCallerLeave', 'QueueMemberAdded', 'QueueMemberPause',
+        'QueueMemberPaused', 'QueueMemberRemoved', 'QueueMemberStatus'),
+    'call': (
+        'AttendedTransfer', 'BlindTransfer', 'Bridge', 'BridgeCreate',
+        'BridgeDestroy', 'BridgeEnter', 'BridgeLeave', 'DeviceStateChange',
+        'Dial', 'DialBegin', 'DialEnd', 'DialState', 'ExtensionStatus',
+        'Hangup', 'HangupRequest', 'Hold', 'Join', 'Leave', 'LocalBridge',
+        'Masquerade', 'MusicOnHoldStart', 'MusicOnHoldStop', 'NewCallerid',
+        'NewConnectedLine', 'Newchannel', 'Newstate', 'OriginateResponse',
+        'Pickup', 'Rename', 'SoftHangupRequest', 'Transfer', 'Unhold'),
+    'cdr': ('Cdr',),
+    'cel': ('CEL',),
+    'dialplan': ('NewAccountCode', 'Newexten', 'VarSet'),
+    'dtmf': ('DTMF', 'DTMFBegin', 'DTMFEnd'),
+    'system': (
+        'ContactStatus', 'FullyBooted', 'PeerStatus', 'Registry', 'Reload',
+        'Shutdown'),
+    'user': ('UserEvent',),
+}
+
+
+def events_to_mask(events):
+    """
+    Return the Events: category mask needed to receive the listed events:
+    'off' if there are none, 'on' if we don't know the category of one of
+    them, otherwise a comma separated list of categories.
+    """
+    categories = set()
+    for event in events:
+        for category, category_events in EVENT_CATEGORIES.items():
+            if event in category_events:
+                categories.add(category)
+                break
+        else:
+            return 'on'
+    return ','.join(sorted(categories)) or 'off'
+
+
+def events_to_filter(events):
+    """
+    Return an AMI Filter regex (POSIX extended) that only lets the listed
+    events through.
+    """
+    return 'Event: (%s)[[:space:]]' % ('|'.join(sorted(events)),)
+
+
+class RttEstimator(object):
+    """
+    Smoothed round trip time and round trip time variance of a host, and
+    the retransmission timeout derived from them, like TCP does it (RFC
+    6298). Timeouts double (up to max_rto) on every backoff() call, until
+    the next sample comes in.
+
+    Use rtt_estimator() to get the process-wide one for a host, so the
+    knowledge survives the connections.
+    """
+    alpha = 1 / 8.0
+    beta = 1 / 4.0
+    initial_rto = 1.0  # before we have any samples
+    min_rto = 0.2
+    max_rto = 30.0
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+        self._backoff = 1
+        self._lock = threading.Lock()
+
+    def sample(self, rtt):
+        """
+        Feed a measured round trip time.
+        """
+        with self._lock:
+            if self.srtt is None:
+                self.srtt, self.rttvar = rtt, rtt / 2.0
+            else:
+                self.rttvar = ((1 - self.beta) * self.rttvar +
+                               self.beta * abs(self.srtt - rtt))
+                self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+            self.samples += 1
+            self._backoff = 1
+
+    def backoff(self):
+        """
+        Call when something timed out: double the timeouts.
+        """
+        with self._lock:
+            if self.rto() < self.max_rto:
+                self._backoff *= 2
+
+    def rto(self):
+        """
+        Return the retransmission timeout: srtt + 4 * rttvar, clamped.
+        """
+        if self.srtt is None:
+            rto = self.initial_rto
+        else:
+            rto = max(self.srtt + 4 * self.rttvar, self.min_rto)
+        return min(rto * self._backoff, self.max_rto)
+
+
+_rtt_estimators = {}  # (host, port) => RttEstimator
+_rtt_estimators_lock = threading.Lock()
+
+
+def rtt_estimator(host, port=5038):
+    """
+    Return the process-wide RttEstimator for host and port.
+    """
+    with _rtt_estimators_lock:
+        try:
+            return _rtt_estimators[(host, port)]
+        except KeyError:
+            ret = _rtt_estimators[(host, port)] = RttEstimator()
+            return ret
+
+
 class SequentialAmi(object):
     # Disconnect modes
     DIS_NEVER = 1        # keep the connection open
     DIS_WHEN_DONE = 2    # disconnect when all actions are done
     DIS_IMMEDIATELY = 3  # disconnect when all actions are submitted
 
+    # The keepalive intervals are varied by this fraction, so lots of
+    # connections don't end up pinging at the same time.
+    keepalive_jitter = 0.1
+
+    # Seconds we allow the server to think about a request, on top of the
+    # network round trips. See timeout().
+    server_time = 1.5
+
     def __init__(self, host, port=5038, username='username', secret='secret',
-                 auth='plain', keepalive=None, disconnect_mode=DIS_WHEN_DONE):
+                 auth='plain', keepalive=None, disconnect_mode=DIS_WHEN_DONE,
+                 events=None, pong_timeout=5, executor=None):
+        """
+        If you pass a CallbackExecutor in executor, the action callbacks and
+        on_output callbacks are run by it, instead of from work(). The
+        callbacks must then not touch this SequentialAmi themselves.
+
+        If you pass keepalive, a Ping is sent when nothing has been received
+        for that many seconds. If no data arrives within pong_timeout
+        seconds after that, the connection is considered dead.
+
+        If you pass a list of event names in events, Asterisk is told to
+        only send those: the login Events: mask is set to the needed
+        categories and a Filter action is sent after login. (The Filter
+        action needs write=system permissions; if it's refused, we get the
+        whole categories.) By default no events are
+        sent at all, except the ones belonging to our actions.
+        """
         if disconnect_mode not in (
                 self.DIS_NEVER, self.DIS_WHEN_DONE, self.DIS_IMMEDIATELY):
             raise TypeError("invalid disconnect mode %r" % (disconnect_mode,))
         self._username = username
         self._secret = secret
         self._disconnect_mode = disconnect_mode
+        self._executor = executor
+        self._events = sorted(set(events or ()))
 
         # Privates
-        self._sock = TokenBufferedSocket(token=b'\r\n', on_data=self._on_line)
+        # Split on LF instead of CRLF: Command output lines are LF-terminated
+        # and we want to be able to stream those.
+        self._sock = TokenBufferedSocket(token=b'\n', on_data=self._on_line)
         self._first = True
         self._done = False
-        self._iterations = 0
+        self._rtt = rtt_estimator(host, port)
+        self._sent = None  # when the last action was written
         self._inbuf, self._outbuf = [], []
         self._action_id = 0
         self._action_id_prefix = '%f-' % (time.time(),)  # should be unique-ish
         self._actions = {}
+        self._on_output = None  # (on_output, parameters) while streaming
         # If you're going to add events asynchronously and calling next_action
         # on them, you need to check if we're authenticated first. Otherwise
         # we'd start sending login messages out of order.
@@ -302,24 +618,31 @@ class SequentialAmi(object):
                 # Enable events using the Events-action. You don't need this
                 # unless you're listening for the FullyBooted event which is
                 # sent immediately. (See _on_login_challenge() too.)
-                'Events': 'off',
+                'Events': events_to_mask(self._events),
             }, callback=self._on_login_response)
         else:
             raise TypeError('Unknown auth type for host "%s"', auth)
 
-        # Connect immediately
+        # Connect immediately. The TCP handshake is a round trip too.
         try:
+            self._connected = time.time()
             self._sock.connect(host, port)
         except Exception as e:
             # Re-raise with the original stack frame but a slightly altered
             # exception.
             raise MonAmiConnectFailed(
                 'connecting to %s: %s' % (host, e)) from e
+        self._rtt.sample(time.time() - self._connected)
+        self._connected = time.time()
 
-        # Schedule a new ping.
-        self._keepalive = 5  # login timeout being this + ping timeout
+        # Schedule the login timeout: welcome message, challenge and login.
+        self._keepalive = None
         self._user_keepalive = keepalive
-        self._keepalive_on_pong(None, None)
+        self._pong_timeout = pong_timeout
+        self._ping_action_id = None
+        self._ping_sent = None
+        self._welcome_timeout = self.timeout(1)
+        self._sock.alarm(self.timeout(3, 2), self._keepalive_check)
 
     def is_authenticated(self):
         """
@@ -351,6 +674,14 @@ class SequentialAmi(object):
         """
         return self._is_authenticated
 
+    def timeout(self, round_trips, server_times=1):
+        """
+        Return how many seconds to wait for something that takes
+        round_trips network round trips and server_times times the server
+        think time, based on the round trip times seen for this host.
+        """
+        return server_times * self.server_time + round_trips * self._rtt.rto()
+
     def trace(self, message):
         """
         A way to debug this.
@@ -359,30 +690,61 @@ class SequentialAmi(object):
         pass
 
     def on_dict(self, dict):
+        if self._ping_action_id and dict.get('ActionID') == (
+                self._ping_action_id):
+            self._keepalive_on_pong()
+            return
+        if self._ping_action_id:
+            # Other data came in between the ping and the pong.
+            self._ping_sent = None
         try:
             action = self._actions[dict['ActionID']]
         except KeyError:
             self.on_unexpected(dict)
         else:
-            self.on_response(dict, action[0], action[1], action[2])
+            self.on_response(dict, action[0], action[1], action[2],
+                             action[4])
 
-    def on_response(self, dict, input, callback=None, stop_event=None):
+    def on_response(self, dict, input, callback=None, stop_event=None,
+                    on_error=None):
         # print 'Response:', dict, 'to', input
         event = dict.get('Event')
         response = dict.get('Response')
         if not event and response not in ('Success', 'Follows'):
             if 'Secret' in input:
                 input['Secret'] = '(hidden)'
-            exception = MonAmiActionFailed(input, dict)
-            self._sock.abort(exception)
-            return
+            if not on_error:
+                exception = MonAmiActionFailed(input, dict)
+                self._sock.abort(exception)
+                return
+            callback, stop_event = on_error, None
+
+        done = not stop_event or event == stop_event
+        if done:
+            # Forget the action before the callback sees the result; long
+            # lived sessions run any number of them.
+            self._actions.pop(input.get('ActionID'), None)
 
         if callback:
-            callback(dict, input)
+            if getattr(callback, '__self__', None) is self:
+                callback(dict, input)  # our own (login) callbacks run inline
+            else:
+                self.dispatch(callback, dict, input)
 
-        if not stop_event or event == stop_event:
+        if done:
             self.next_action()
 
+    def dispatch(self, callback, *args):
+        """
+        Call the callback, through the executor if there is one. Use this
+        from on_unexpected() if you override it and want your event handling
+        offloaded as well.
+        """
+        if self._executor:
+            self._executor.submit(self, callback, *args)
+        else:
+            callback(*args)
+
     def on_unexpected(self, dict):
         """
         This may be expected or unexpected, but it is not matched to a
@@ -397,28 +759,51 @@ class SequentialAmi(object):
             print('Unexpected:', dict)
 
     def add_action(self, action, parameters, callback=None, stop_event=None,
-                   insertpos=None):
+                   insertpos=None, on_output=None, on_error=None):
         """
         Add an action to fire when the previous action has completed. If you
         supply a custom callback, you don't need to call next_action(). It will
         be done for you. If you supply stop_event, a command will not be marked
         as completed until that event has been received.
+
+        If you supply on_output, Command output is not collected in the
+        response dict[''], but passed to on_output(line, parameters) line by
+        line, as it arrives.
+
+        An error response normally aborts the connection with
+        MonAmiActionFailed. If you supply on_error, it is called as
+        on_error(dict, parameters) instead and the next action is fired.
         """
         self._action_id += 1
         identifier = self._action_id_prefix + str(self._action_id)
         parameters['Action'] = action
         parameters['ActionID'] = identifier
 
-        self._actions[identifier] = (parameters, callback, stop_event)
-        msg = ('\r\n'.join(['%s: %s' % (k, parameters[k]) for k in parameters])
-               + '\r\n\r\n')
-        msg = msg.encode('utf-8')
+        self._actions[identifier] = (
+            parameters, callback, stop_event, on_output, on_error)
+        msg = self._to_message(parameters)
 
         if insertpos is None:
             self._outbuf.append(msg)
         else:
             self._outbuf.insert(insertpos, msg)
 
+    def send(self, parameters):
+        """
+        Send an action right away, bypassing the sequential action queue.
+        Set the Action and ActionID yourself; the responses end up in
+        on_unexpected().
+        """
+        data = self._to_message(parameters)
+        self.trace('}} %r\n' % (data,))
+        self._sock.write(data)
+
+    @staticmethod
+    def _to_message(parameters):
+        msg = ('\r\n'.join(['%s: %s' % (k, parameters[k]) for k in parameters])
+               + '\r\n\r\n')
+        return msg.encode('utf-8')
+
     def next_action(self):
         """
         Load up the next action. This is called by the default on_response()
@@ -433,6 +818,7 @@ class SequentialAmi(object):
                 not self._outbuf and
                 self._disconnect_mode == self.DIS_IMMEDIATELY)
             self._sock.write(data, shutdown_when_written=last_action)
+            self._sent = time.time()
             if last_action:
                 self._done = True
         elif self._disconnect_mode == self.DIS_WHEN_DONE:
@@ -441,32 +827,66 @@ class SequentialAmi(object):
             self._sock.abort()
             self._done = True
 
-    def process(self, absolute_timeout=5, relative_timeout=2):
+    def process(self, absolute_timeout=None, relative_timeout=None):
+        """
+        Run until done. If the timeouts are not given, they are derived from
+        the round trip times of the host (see timeout()): relative_timeout
+        is the time we wait for more data, absolute_timeout the time we
+        wait for the welcome message, the login and all queued actions.
+        """
         # If disconnect_mode is not never, we expect results fairly quickly, so
         # there's a timeout.
         if self._disconnect_mode != self.DIS_NEVER:
+            if relative_timeout is None:
+                relative_timeout = self.timeout(1)
+            if absolute_timeout is None:
+                absolute_timeout = self.timeout(
+                    3 + len(self._outbuf), 2)
             self._sock.loop(
                 absolute_timeout=absolute_timeout,
                 relative_timeout=relative_timeout)
             if not self._done:
+                self._rtt.backoff()
                 raise MonAmiTimeout()  # XXX: add delta
+            if self._executor:
+                self._executor.wait()
         else:
             # First log in.. first then go to infinite loop mode
-            # (work() takes 0.333 seconds per run if no data is received)
-            for i in range(10):
-                if self._sock.work() is None:
-                    raise MonAmiReset('Connection broken')
-            if self._first:
-                raise MonAmiError('No timely welcome message')
+            while self._first:
+                self.work()
             self._sock.loop()
 
-    def work(self):
+    def close(self):
+        """
+        Drop the connection. Errors caused by the remaining unprocessed data
+        are ignored.
+        """
+        try:
+            self._sock.abort()
+        except MonAmiException:
+            pass
+
+    def fileno(self):
+        """
+        Return the file descriptor of the underlying socket, or None if the
+        connection is gone.
+        """
+        return self._sock.fileno()
+
+    def has_output(self):
+        """
+        Return True if the underlying socket has data waiting to be written.
+        """
+        return self._sock.has_output()
+
+    def work(self, timeout=None):
         # Manual work, if you're combining multiple instances
-        ret = self._sock.work()
+        ret = self._sock.work(timeout)
         if ret is None:
             raise MonAmiReset('Connection broken')
-        self._iterations += 1
-        if self._first and self._iterations == 10:
+        if self._first and (
+                time.time() - self._connected > self._welcome_timeout):
+            self._rtt.backoff()
             raise MonAmiError('No timely welcome message')
         if self._done and self._disconnect_mode != self.DIS_NEVER:
             raise MonAmiFinished('Done')
@@ -487,22 +907,57 @@ class SequentialAmi(object):
         if data == b'\r\n':
             self._on_raw_dict(self._inbuf)
             self._inbuf = []
-        elif not data.endswith(b'\r\n'):  # apparently EOF
+            self._on_output = None
+        elif not data.endswith(b'\n'):  # apparently EOF
             if len(data):
-                self._inbuf.append(self._inbuf)
+                self._inbuf.append(data)
             if len(self._inbuf):
                 self._on_raw_dict(self._inbuf)
             self._inbuf = []
             raise MonAmiError('Got EOF from other end')
+        elif self._on_output and self._is_output_line(data):
+            # Streaming command output: pass it along instead of collecting
+            # it in memory.
+            output = self._output_from_line(data)
+            if output:
+                self.dispatch(self._on_output[0], output.decode('utf-8'),
+                              self._on_output[1])
         else:
+            if data.startswith(b'ActionID:'):
+                action = self._actions.get(
+                    data.split(b':', 1)[1].strip().decode('ascii'))
+                if action and action[3]:
+                    self._on_output = (action[3], action[0])
             self._inbuf.append(data)
 
+    @staticmethod
+    def _is_output_line(line):
+        """
+        Asterisk 13 and lower send Command output as raw LF-terminated lines,
+        ending with --END COMMAND--; newer versions send Output headers.
+        """
+        return (not line.endswith(b'\r\n') or
+                line.endswith(b'--END COMMAND--\r\n') or
+                line.startswith(b'Output:'))
+
+    @staticmethod
+    def _output_from_line(line):
+        if line.startswith(b'Output:'):
+            line = line[7:]
+            if line.startswith(b' '):
+                line = line[1:]
+            return line[0:-2] + b'\n'  # CRLF to LF, like the old output
+        elif line.endswith(b'--END COMMAND--\r\n'):
+            return line[0:-17]  # drop '--END COMMAND--\r\n'
+        return line
+
     def _on_raw_dict(self, raw_dict):
-        dict = {}
+        dict, output = {}, []
         for i, line in enumerate(raw_dict):
-            if (line.endswith(b'--END COMMAND--\r\n') and
-                    dict.get('Response') == 'Follows'):
-                dict[''] = line[0:-17]  # drop '--END COMMAND--\r\n'
+            if ((dict.get('Response') == b'Follows' or
+                    line.startswith(b'Output:')) and
+                    self._is_output_line(line)):
+                output.append(self._output_from_line(line))
             else:
                 key, value = line.split(b':', 1)
                 dict[key.strip().decode('ascii')] = value.strip()
@@ -510,53 +965,111 @@ class SequentialAmi(object):
         # Decode values:
         for k, v in dict.items():
             dict[k] = v.decode('utf-8')
+        if output:
+            # Repeated Output headers or the raw --END COMMAND-- output are
+            # joined into a single string.
+            dict[''] = b''.join(output).decode('utf-8')
 
         self.trace('{{ %r\n' % (dict,))
         self.on_dict(dict)
 
     # Challenge login handling
     def _on_login_challenge(self, response, request):
+        self._rtt.sample(time.time() - self._sent)
         # Add a login action, and prepend it.
         self.add_action('login', {
             'AuthType': 'MD5',
             'Username': self._username,
             'Key': (
-                md5(response['Challenge'].encode('ascii') + self._secret)
+                md5(response['Challenge'].encode('ascii') +
+                    self._secret.encode('utf-8'))
                 .hexdigest()),
             # Enable events using the Events-action. You don't need this unless
             # you're listening for the FullyBooted event which is sent
             # immediately.
-            'Events': 'off',
+            'Events': events_to_mask(self._events),
         }, callback=self._on_login_response, insertpos=0)
 
     def _on_login_response(self, response, request):
+        self._rtt.sample(time.time() - self._sent)
         # Set flag that we're logged in.
         self._is_authenticated = True
         # Set the regular keepalive time instead of the during-login keepalive
         # time.
         self._keepalive = self._user_keepalive
+        if self._keepalive:
+            self._keepalive_schedule(self._keepalive)
+        else:
+            self._sock.cancel_alarm()  # the login timeout
+        # Have the server drop the events we're not interested in, instead of
+        # serializing them and sending them over the wire for nothing.
+        if self._events:
+            self.add_action('Filter', {
+                'Operation': 'Add',
+                'Filter': events_to_filter(self._events),
+            }, insertpos=0, on_error=self._on_filter_error)
+
+    def _on_filter_error(self, dict, input):
+        # No write=system permissions, or an Asterisk older than 1.8 that
+        # doesn't know the action. The Events: mask still applies.
+        pass
 
     # Keepalive handling
+    def _keepalive_schedule(self, seconds):
+        jitter = self.keepalive_jitter
+        self._sock.alarm(seconds * random.uniform(1 - jitter, 1 + jitter),
+                         self._keepalive_check)
+
+    def _keepalive_check(self):
+        if self._sock.fileno() is None:
+            return  # already gone
+        if not self._is_authenticated:
+            self._rtt.backoff()
+            self._sock.abort(MonAmiTimeout('Login timeout'))
+            return
+        # Only if _keepalive. Now we can alter the keepalive time during the
+        # running of the program.
+        if not self._keepalive:
+            return
+        # If we heard from the other end recently, it's alive. No need to
+        # ping.
+        idle = self._sock.idle_time()
+        if idle < self._keepalive:
+            self._keepalive_schedule(self._keepalive - idle)
+        else:
+            self._keepalive_ping()
+
     def _keepalive_ping(self):
-        # Enqueue a ping as first next action.
-        self.add_action('ping', {
-        }, callback=self._keepalive_on_pong, insertpos=0)
-        # Set a new alarm for it. Wait 5 seconds for the pong.
-        # OBSERVE: these hardcoded 5 seconds will cause the minimum
-        # ping keepalive to be at least 5, since the next alarm will
-        # be scheduled first on pong_alarm.
-        self._sock.alarm(5, self._keepalive_pong_alarm)
-        # Force the ping to go out immediately.
-        self.next_action()
-
-    def _keepalive_on_pong(self, response, request):
+        # Write the ping straight to the socket instead of to the action
+        # queue. The pong is picked up in on_dict(), so it doesn't hold up
+        # (or get held up by) the queued actions.
+        self._action_id += 1
+        self._ping_action_id = self._action_id_prefix + str(self._action_id)
+        self._sock.write(('Action: Ping\r\nActionID: %s\r\n\r\n' % (
+            self._ping_action_id,)).encode('ascii'))
+        self._ping_sent = time.time()
+        self._sock.alarm(self._pong_timeout, self._keepalive_pong_alarm)
+
+    def _keepalive_on_pong(self):
+        # A pong that got stuck behind other data is no good round trip
+        # time sample; on_dict() and _keepalive_pong_alarm() unset
+        # _ping_sent when that happens.
+        if self._ping_sent:
+            self._rtt.sample(time.time() - self._ping_sent)
         # Re-schedule the ping. Discard the _keepalive_pong_alarm.
+        self._ping_action_id = None
         if self._keepalive:
-            # Only if _keepalive. Now we can alter the keepalive time
-            # during the running of the program.
-            self._sock.alarm(self._keepalive, self._keepalive_ping)
+            self._keepalive_schedule(self._keepalive)
+        else:
+            self._sock.cancel_alarm()
 
     def _keepalive_pong_alarm(self):
+        # No pong yet. If other data did arrive, the pong is probably stuck
+        # behind a large response; give it some more time.
+        if self._sock.idle_time() < self._pong_timeout:
+            self._ping_sent = None
+            self._sock.alarm(self._pong_timeout, self._keepalive_pong_alarm)
+            return
         # Connection broken? Tear it down and raise an exception.
         self._sock.abort(MonAmiTimeout('Ping timeout'))
 
@@ -584,15 +1097,36 @@ class MultiHostSequentialAmi(object):
             print len(errors), 'reloads failed'
     """
 
-    def __init__(self):
+    def __init__(self, executor=None, min_hosts=None, tail_timeout=0):
+        """
+        If you pass a CallbackExecutor, the callbacks of all connections are
+        run by it (see SequentialAmi); process() waits for them.
+
+        If you set min_hosts, process() stops waiting for the stragglers
+        tail_timeout seconds after that many hosts have completed. The
+        stragglers are disconnected and listed in missing (and in the
+        errors, with a MonAmiTimeout). The ActionIDs of the actions of all
+        hosts that did not complete, stragglers or failed, are in
+        missing_action_ids, so you can drop their partial results.
+        """
         self._amis = []
         self._actions = []
         self._errors = []
+        self._executor = executor
+        self.min_hosts = min_hosts
+        self.tail_timeout = tail_timeout
+        self.completed = []
+        self.missing = []
+        self.missing_action_ids = set()
 
-    def add_action(self, action, parameters, callback=None, stop_event=None):
-        self._actions.append((action, parameters, callback, stop_event))
+    def add_action(self, action, parameters, callback=None, stop_event=None,
+                   on_output=None):
+        self._actions.append(
+            (action, parameters, callback, stop_event, on_output))
 
     def add_connection(self, **kwargs):
+        if self._executor:
+            kwargs.setdefault('executor', self._executor)
         try:
             s = SequentialAmi(**kwargs)
         except Exception as e:
@@ -602,24 +1136,394 @@ class MultiHostSequentialAmi(object):
 
     def process(self):
         # Enqueue the actions
+        action_ids = {}
         for kwargs, ami in self._amis:
-            for action, parameters, callback, stop_event in self._actions:
-                ami.add_action(action, parameters, callback, stop_event)
-
-        # Loop until all amis are complete or have errors
+            action_ids[id(ami)] = []
+            for (action, parameters, callback, stop_event,
+                    on_output) in self._actions:
+                parameters = dict(parameters)
+                ami.add_action(
+                    action, parameters, callback, stop_event,
+                    on_output=on_output)
+                action_ids[id(ami)].append(parameters['ActionID'])
+
+        # Loop until all amis are complete or have errors, or until the
+        # tail deadline after the quorum has been reached
+        deadline = None
         while self._amis:
             for kwargs, ami in self._amis:
                 try:
                     ami.work()
                 except MonAmiFinished:
+                    self.completed.append(kwargs)
                     self._amis.pop(self._amis.index((kwargs, ami)))  # drop it
                 except Exception as e:
                     self._errors.append((kwargs, e))
+                    self.missing_action_ids.update(action_ids[id(ami)])
                     self._amis.pop(self._amis.index((kwargs, ami)))  # drop it
 
+            if (deadline is None and self.min_hosts is not None and
+                    len(self.completed) >= self.min_hosts):
+                deadline = time.time() + self.tail_timeout
+            if deadline is not None and time.time() >= deadline:
+                for kwargs, ami in self._amis:
+                    ami.close()
+                    self.missing.append(kwargs)
+                    self.missing_action_ids.update(action_ids[id(ami)])
+                    self._errors.append((kwargs, MonAmiTimeout(
+                        'Detached after %d hosts completed' % (
+                            len(self.completed),))))
+                self._amis = []
+
+        if self._executor:
+            self._executor.wait()
         return self._errors
 
 
+class EventMerger(object):
+    """
+    Merge the event streams of multiple hosts into one, ordered by time.
+
+    Every event is stamped with the time it was received. Events are
+    ordered by their Timestamp header (set timestampevents=yes in
+    manager.conf) if they have one, and by the receive time otherwise.
+
+    The events of each host are kept in a FIFO; a heap of the FIFO heads
+    does the k-way merge. Events are held back for at most window seconds
+    after they were received, so events from other hosts that arrive a bit
+    later can still be sorted in front of them.
+
+    Example usage::
+
+        merger = EventMerger(window=1.0)
+        # From your on_unexpected():
+        merger.push('pbx1', dict)
+        # Regularly:
+        for when, host, received, dict in merger.pop():
+            print(host, when, dict['Event'])
+    """
+    def __init__(self, window=1.0):
+        self.window = window
+        self._queues = {}  # host => deque of (when, received, dict)
+        self._heap = []    # (when, seq, host) of the queue heads
+        self._seq = 0      # tie breaker, keeps the heap stable
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def push(self, host, dict, received=None):
+        if received is None:
+            received = time.time()
+        try:
+            when = float(dict['Timestamp'])
+        except (KeyError, ValueError):
+            when = received
+        queue = self._queues.setdefault(host, deque())
+        queue.append((when, received, dict))
+        if len(queue) == 1:
+            self._push_head(host)
+
+    def pop(self, now=None, flush=False):
+        """
+        Yield the events that have been held back long enough (or all of
+        them, if flush is set) as (when, host, received, dict) tuples, in
+        order.
+        """
+        if now is None:
+            now = time.time()
+        while self._heap:
+            when, seq, host = self._heap[0]
+            queue = self._queues[host]
+            received = queue[0][1]
+            if not flush and received > now - self.window:
+                break
+            heapq.heappop(self._heap)
+            when, received, dict = queue.popleft()
+            if queue:
+                self._push_head(host)
+            yield when, host, received, dict
+
+    def _push_head(self, host):
+        self._seq += 1
+        heapq.heappush(
+            self._heap, (self._queues[host][0][0], self._seq, host))
+
+
+def ready_amis(amis, timeout):
+    """
+    Wait at most timeout seconds until one or more of the SequentialAmis
+    have I/O pending, and return those. Call work(0) on them afterwards.
+    Broken connections are returned as ready too, so work() can raise.
+
+    Unlike calling work() on each of them in turn, this doesn't wait
+    (up to) the select timeout for every idle connection. Do call work() on
+    all of them every once in a while (e.g. every 0.333 seconds) so the
+    alarms and welcome message checks get run.
+    """
+    rlist, wlist, ready = [], [], []
+    byfd = {}
+    for ami in amis:
+        fd = ami.fileno()
+        if fd is None:
+            ready.append(ami)
+            continue
+        byfd[fd] = ami
+        rlist.append(fd)
+        if ami.has_output():
+            wlist.append(fd)
+    if ready:
+        return ready
+    if not rlist:
+        time.sleep(timeout)
+        return ready
+    rlist, wlist, xlist = select.select(rlist, wlist, (), timeout)
+    for fd in set(rlist + wlist):
+        ready.append(byfd[fd])
+    return ready
+
+
+class BackgroundAmi(object):
+    """
+    Run one or more SequentialAmis from a single background thread. All
+    sockets are owned by that thread; other threads submit actions through
+    add_action(), which is thread-safe and returns a
+    concurrent.futures.Future.
+
+    The future result is a (response, events) tuple: the response dict and a
+    list of the event dicts collected up to and including the stop_event. If
+    the action fails or the connection breaks, the future gets the
+    exception instead.
+
+    Example usage::
+
+        b = BackgroundAmi()
+        b.add_connection(host='server1', username='user', secret='pass')
+        b.start()
+
+        # From any (WSGI worker) thread:
+        future = b.add_action(
+            'server1', 'QueueSummary', {'Queue': '22'},
+            stop_event='QueueSummaryComplete')
+        response, events = future.result(timeout=5)
+
+        # When shutting down:
+        b.close()
+    """
+
+    def __init__(self):
+        self._amis = {}      # name => SequentialAmi (I/O thread only)
+        self._futures = {}   # name => set of pending futures (I/O thread only)
+        self._errors = []
+        self._alive = set()   # names of live connections
+        self._lock = threading.Lock()
+        self._submitted = []  # (name, ami, action, ...) from other threads
+        self._closing = False
+        self._thread = None
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(0)
+        self._wakeup_w.setblocking(0)
+
+    def add_connection(self, name=None, **kwargs):
+        """
+        Connect to an AMI host; see SequentialAmi for the arguments. The
+        connection is identified by name, which defaults to the host. The
+        connect is done in the calling thread, so a connect error is raised
+        here. Returns the name.
+        """
+        kwargs.setdefault('keepalive', 60)
+        kwargs.setdefault('disconnect_mode', SequentialAmi.DIS_NEVER)
+        if kwargs['disconnect_mode'] != SequentialAmi.DIS_NEVER:
+            raise TypeError('BackgroundAmi connections require DIS_NEVER')
+        if name is None:
+            name = kwargs['host']
+        ami = SequentialAmi(**kwargs)
+        with self._lock:
+            self._alive.add(name)
+            self._submitted.append((name, ami, None, None, None, None))
+        self._wakeup()
+        return name
+
+    def add_action(self, name, action, parameters, stop_event=None):
+        """
+        Enqueue an action for the connection called name. Thread-safe.
+        Returns a concurrent.futures.Future.
+        """
+        future = Future()
+        with self._lock:
+            if self._closing:
+                raise MonAmiException('BackgroundAmi is closed')
+            self._submitted.append(
+                (name, None, action, dict(parameters), stop_event, future))
+        self._wakeup()
+        return future
+
+    def errors(self):
+        """
+        Return a list of (name, error) tuples of connections that died.
+        """
+        with self._lock:
+            return list(self._errors)
+
+    def connections(self):
+        """
+        Return the set of names of the connections that are still alive.
+        """
+        with self._lock:
+            return set(self._alive)
+
+    def start(self):
+        """
+        Start the background I/O thread.
+        """
+        assert self._thread is None
+        self._thread = threading.Thread(
+            target=self._run, name='BackgroundAmi')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self, timeout=None):
+        """
+        Stop the I/O thread and drop all connections. Pending futures get a
+        MonAmiReset exception.
+        """
+        with self._lock:
+            self._closing = True
+        self._wakeup()
+        if self._thread:
+            self._thread.join(timeout)
+        else:
+            self._shutdown()
+
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b'.')
+        except socket.error:
+            pass  # buffer full: the I/O thread will wake up anyway
+
+    def _run(self):
+        try:
+            tick, tick_interval = (
+                time.time(), TokenBufferedSocket.select_timeout)
+            while True:
+                with self._lock:
+                    closing = self._closing
+                    submitted, self._submitted = self._submitted, []
+                if closing:
+                    break
+                for item in submitted:
+                    self._handle_submitted(*item)
+
+                rlist, wlist = [self._wakeup_r], []
+                byfd = {}
+                for name, ami in self._amis.items():
+                    fd = ami.fileno()
+                    if fd is not None:
+                        byfd[fd] = name
+                        rlist.append(fd)
+                        if ami.has_output():
+                            wlist.append(fd)
+
+                timeout = max(0, tick + tick_interval - time.time())
+                rlist, wlist, xlist = select.select(rlist, wlist, (), timeout)
+                if self._wakeup_r in rlist:
+                    try:
+                        self._wakeup_r.recv(4096)
+                    except socket.error:
+                        pass
+
+                # Every tick, all connections get a work() call, so alarms
+                # (keepalives) and the welcome message checks are run.
+                # Otherwise only the connections that have I/O pending.
+                if time.time() >= tick + tick_interval:
+                    tick = time.time()
+                    names = list(self._amis.keys())
+                else:
+                    names = set(byfd[fd] for fd in rlist + wlist if fd in byfd)
+                for name in names:
+                    self._work(name)
+        finally:
+            self._shutdown()
+
+    def _handle_submitted(self, name, ami, action, parameters, stop_event,
+                          future):
+        if ami is not None:
+            if name in self._amis:
+                self._amis[name].close()
+                self._fail(name, MonAmiReset('Connection replaced'))
+            self._amis[name] = ami
+            self._futures[name] = set()
+            return
+
+        if not future.set_running_or_notify_cancel():
+            return  # cancelled before we got to it
+        ami = self._amis.get(name)
+        if ami is None:
+            future.set_exception(
+                MonAmiException('No connection named %r' % (name,)))
+            return
+
+        events = []
+
+        def callback(dict, input):
+            if dict.get('Event'):
+                events.append(dict)
+            else:
+                response[:] = [dict]
+            if not stop_event or dict.get('Event') == stop_event:
+                self._futures[name].discard(future)
+                future.set_result((response[0] if response else None, events))
+
+        def on_error(dict, input):
+            # Only this action failed; the connection stays usable.
+            self._futures[name].discard(future)
+            future.set_exception(MonAmiActionFailed(input, dict))
+
+        response = []
+        self._futures[name].add(future)
+        ami.add_action(action, parameters, callback=callback,
+                       stop_event=stop_event, on_error=on_error)
+        if ami.is_authenticated():
+            ami.next_action()
+        self._work(name, timeout=0)
+
+    def _work(self, name, timeout=0):
+        ami = self._amis.get(name)
+        if ami is None:
+            return
+        try:
+            ami.work(timeout)
+        except Exception as e:
+            ami.close()
+            del self._amis[name]
+            with self._lock:
+                self._alive.discard(name)
+                self._errors.append((name, e))
+            self._fail(name, e)
+
+    def _fail(self, name, error):
+        for future in self._futures.pop(name, ()):
+            if not future.done():
+                future.set_exception(error)
+
+    def _shutdown(self):
+        with self._lock:
+            self._closing = True
+            submitted, self._submitted = self._submitted, []
+        for name, ami, action, parameters, stop_event, future in submitted:
+            if ami is not None:
+                ami.close()
+            elif future.set_running_or_notify_cancel():
+                future.set_exception(MonAmiReset('BackgroundAmi closed'))
+        for name, ami in list(self._amis.items()):
+            ami.close()
+            self._fail(name, MonAmiReset('BackgroundAmi closed'))
+        self._amis = {}
+        with self._lock:
+            self._alive.clear()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+
 def main():
     # s = TokenBufferedSocket()
     # s.connect('server1', 5038)
@@ -635,14 +1539,36 @@ def main():
         s.process()
 
     elif command == 'listen':
+        # Optionally followed by sink=SPEC (see monamisink) and/or the names
+        # of the events to listen for.
+        events = [i for i in sys.argv[5:] if not i.startswith('sink=')]
+        sinks = [i[5:] for i in sys.argv[5:] if i.startswith('sink=')]
         s = SequentialAmi(
             host, username=username, secret=secret, auth='md5',
             keepalive=60,
-            disconnect_mode=SequentialAmi.DIS_NEVER)
-        # If you have read=all perms in your manager.conf, you'll get flooded
-        # with events now :)
-        s.add_action('events', {'EventMask': 'on'})
-        s.process()
+            disconnect_mode=SequentialAmi.DIS_NEVER, events=events)
+        if not events:
+            # If you have read=all perms in your manager.conf, you'll get
+            # flooded with events now :)
+            s.add_action('events', {'EventMask': 'on'})
+        if sinks:
+            sink = make_sink(sinks[0])
+
+            def on_unexpected(dict):
+                received = time.time()
+                try:
+                    when = float(dict['Timestamp'])
+                except (KeyError, ValueError):
+                    when = received
+                sink.write(host, when, received, dict)
+
+            s.on_unexpected = on_unexpected
+            try:
+                s.process()
+            finally:
+                sink.close()
+        else:
+            s.process()
 
     else:
         # s.add_action('originate', {
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# vim: set ts=8 sw=4 sts=4 et ai tw=79:
+"""
+Poll a fleet of asterisken periodically over persistent AMI sessions and
+keep the history in memory, in fixed-size ring buffers.
+
+Usage::
+
+    monamipoll INTERVAL HOSTS...
+
+This polls the queue summaries, the channel count and the SIP peer status
+of all hosts every INTERVAL seconds and prints the current values with
+their rates over the last minute.
+
+Programmatic usage::
+
+    poller = FleetPoller([amiaddr_to_dict('user:pass@pbx1'), ...])
+    poller.add_query('queuesummary', 10)
+    poller.add_query('channels', 10)
+    poller.add_query('sippeers', 60)
+    thread = threading.Thread(target=poller.run)
+    thread.start()
+    ...
+    buffer = poller.buffer('pbx1:5038', 'callers', queue='22')
+    print(buffer.latest(), buffer.rate(300), buffer.percentile(95, 3600))
+"""
+import heapq
+import sys
+import threading
+import time
+from array import array
+
+# Local friend package.
+from monamish import MonamishDaemon, amiaddr_to_dict
+
+
+class RingBuffer(object):
+    """
+    Fixed-size history of (timestamp, value) samples, stored in two arrays
+    of doubles. When full, the oldest samples are overwritten.
+    """
+    def __init__(self, capacity=1024):
+        assert capacity > 0
+        self.capacity = capacity
+        self._times = array('d', [0.0]) * capacity
+        self._values = array('d', [0.0]) * capacity
+        self._next = 0   # where the next sample goes
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, value):
+        self._times[self._next] = timestamp
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def samples(self, seconds=None, now=None):
+        """
+        Return the (timestamp, value) samples, oldest first. If seconds is
+        set, only the samples of the last that many seconds (relative to
+        now or the newest sample).
+        """
+        start = (self._next - self._count) % self.capacity
+        indexes = [(start + i) % self.capacity for i in range(self._count)]
+        ret = [(self._times[i], self._values[i]) for i in indexes]
+        if seconds is not None and ret:
+            since = (now if now is not None else ret[-1][0]) - seconds
+            ret = [i for i in ret if i[0] >= since]
+        return ret
+
+    def latest(self):
+        """
+        Return the newest value, or None if there are no samples.
+        """
+        if not self._count:
+            return None
+        return self._values[(self._next - 1) % self.capacity]
+
+    def delta(self, seconds=None):
+        """
+        Return the difference between the newest and the oldest value (in
+        the last seconds), or None if there are less than two samples.
+        """
+        samples = self.samples(seconds)
+        if len(samples) < 2:
+            return None
+        return samples[-1][1] - samples[0][1]
+
+    def rate(self, seconds=None):
+        """
+        Return the change per second (in the last seconds), or None if
+        there are less than two samples.
+        """
+        samples = self.samples(seconds)
+        if len(samples) < 2 or samples[-1][0] == samples[0][0]:
+            return None
+        return ((samples[-1][1] - samples[0][1]) /
+                (samples[-1][0] - samples[0][0]))
+
+    def percentile(self, percent, seconds=None):
+        """
+        Return the percentile (0..100) of the values (in the last seconds),
+        using linear interpolation, or None if there are no samples.
+        """
+        values = sorted(value for timestamp, value in self.samples(seconds))
+        if not values:
+            return None
+        pos = (len(values) - 1) * percent / 100.0
+        lower = int(pos)
+        upper = min(lower + 1, len(values) - 1)
+        return values[lower] + (values[upper] - values[lower]) * (pos - lower)
+
+
+def _samples_queuesummary(events):
+    for event in events:
+        if event.get('Event') == 'QueueSummary':
+            queue = event.get('Queue', '')
+            for key, metric in (
+                    ('Available', 'available'), ('Callers', 'callers'),
+                    ('HoldTime', 'holdtime'), ('LoggedIn', 'loggedin'),
+                    ('LongestHoldTime', 'longest_holdtime'),
+                    ('TalkTime', 'talktime')):
+                yield queue, metric, int(event.get(key) or 0)
+
+
+def _samples_channels(events):
+    yield '', 'channels', len(
+        [i for i in events if i.get('Event') == 'CoreShowChannel'])
+
+
+def _samples_sippeers(events):
+    counts = {'ok': 0, 'lagged': 0, 'unreachable': 0, 'unknown': 0}
+    latencies = []
+    for event in events:
+        if event.get('Event') != 'PeerEntry':
+            continue
+        status = event.get('Status', '')
+        if status.startswith('OK'):
+            counts['ok'] += 1
+            # "OK (12 ms)"
+            try:
+                latencies.append(int(status.split('(')[1].split()[0]))
+            except (IndexError, ValueError):
+                pass
+        elif status.startswith('LAGGED'):
+            counts['lagged'] += 1
+        elif status.startswith('UNREACHABLE'):
+            counts['unreachable'] += 1
+        else:
+            counts['unknown'] += 1  # also Unmonitored
+    for status, count in counts.items():
+        yield '', 'sip_peers_%s' % (status,), count
+    if latencies:
+        yield '', 'sip_peer_latency', sum(latencies) / float(len(latencies))
+
+
+class FleetPoller(object):
+    """
+    Run AMI queries on fixed intervals on all hosts, and store the results
+    in a RingBuffer per (host, queue, metric). See the module docstring.
+    The sessions are kept by a MonamishDaemon, with our query_timeout and
+    reconnect_interval.
+    """
+    # name => (action, parameters, stop_event, event to samples function)
+    QUERIES = {
+        'queuesummary': ('QueueSummary', {}, 'QueueSummaryComplete',
+                         _samples_queuesummary),
+        'channels': ('CoreShowChannels', {}, 'CoreShowChannelsComplete',
+                     _samples_channels),
+        'sippeers': ('SIPpeers', {}, 'PeerlistComplete', _samples_sippeers),
+    }
+    query_timeout = 5
+    reconnect_interval = 30
+
+    def __init__(self, ami_kwargs, capacity=1024):
+        self.capacity = capacity
+        self._ami_kwargs = list(ami_kwargs)
+        self._daemon = None
+        self._queries = []  # heap of (next time, name, interval)
+        self._buffers = {}  # (host, queue, metric) => RingBuffer
+        self._lock = threading.Lock()
+        self._running = True
+
+    def add_query(self, name, interval):
+        """
+        Poll query name (see QUERIES) every interval seconds.
+        """
+        if name not in self.QUERIES:
+            raise ValueError('unknown query %r' % (name,))
+        heapq.heappush(self._queries, (time.time(), name, interval))
+
+    def buffer(self, host, metric, queue=''):
+        """
+        Return the RingBuffer for the metric of host (and queue), or None if
+        there's nothing stored for it.
+        """
+        with self._lock:
+            return self._buffers.get((host, queue, metric))
+
+    def keys(self):
+        """
+        Return the (host, queue, metric) tuples we have samples for.
+        """
+        with self._lock:
+            return sorted(self._buffers.keys())
+
+    def close(self):
+        """
+        Stop run() after the current poll.
+        """
+        self._running = False
+
+    def run(self):
+        """
+        Poll until close() is called.
+        """
+        self._daemon = MonamishDaemon(self._ami_kwargs)
+        self._daemon.query_timeout = self.query_timeout
+        self._daemon.reconnect_interval = self.reconnect_interval
+        try:
+            while self._running and self._queries:
+                when, name, interval = self._queries[0]
+                if when > time.time():
+                    time.sleep(max(0, min(0.333, when - time.time())))
+                    continue
+                heapq.heapreplace(
+                    self._queries, (max(when + interval, time.time()), name,
+                                    interval))
+                self.poll(name)
+        finally:
+            self._daemon.close()
+            self._daemon = None
+
+    def poll(self, name):
+        """
+        Run query name once on all hosts and store the samples. Returns a
+        list of (host, error) tuples.
+        """
+        action, parameters, stop_event, to_samples = self.QUERIES[name]
+        results, errors = self._daemon.fetch(
+            [(action, parameters, stop_event)])
+        now = time.time()
+        for host, index, parameters, response, events in results:
+            for queue, metric, value in to_samples(events):
+                self._store(host, queue, metric, now, value)
+        return errors
+
+    def _store(self, host, queue, metric, timestamp, value):
+        key = (host, queue, metric)
+        with self._lock:
+            buffer = self._buffers.get(key)
+            if buffer is None:
+                buffer = self._buffers[key] = RingBuffer(self.capacity)
+            buffer.append(timestamp, value)
+
+
+def main():
+    interval, hosts = float(sys.argv[1]), sys.argv[2:]
+    if not hosts:
+        raise ValueError('Use the source, Luke')
+    poller = FleetPoller([amiaddr_to_dict(i) for i in hosts])
+    for name in sorted(poller.QUERIES):
+        poller.add_query(name, interval)
+    thread = threading.Thread(target=poller.run)
+    thread.daemon = True
+    thread.start()
+    try:
+        while thread.is_alive():
+            time.sleep(interval)
+            for key in poller.keys():
+                buffer = poller.buffer(key[0], key[2], queue=key[1])
+                rate = buffer.rate(60)
+                print('%s\t%s\t%s\t%g\t%s' % (
+                    key + (buffer.latest(),
+                           '-' if rate is None else '%+.3f/s' % (rate,))))
+            print()
+    finally:
+        poller.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+# vim: set ts=8 sw=4 sts=4 et ai tw=79:
+"""
+AMI multiplexing proxy: share a single upstream manager session between
+many downstream AMI clients (wallboards, CRM popups, recorders, ...).
+
+Usage::
+
+    monamiproxy LISTENPORT UPSTREAM LOCALUSER:LOCALPASS [...]
+
+For example::
+
+    monamiproxy 5039 proxy:secret@pbx1 wallboard:pass1 crm:pass2
+
+The downstream clients log in to the proxy with the local credentials
+(plain or MD5 challenge). Their actions are forwarded upstream with a
+rewritten ActionID, so the responses can be routed back to the right
+client. Upstream events are serialized once and sent to every client that
+has events enabled and whose filters (see the AMI Filter action) accept
+the event.
+
+Run one proxy per PBX.
+"""
+import random
+import re
+import select
+import socket
+import sys
+import time
+from hashlib import md5
+
+# Local friend package.
+from monami import (
+    EVENT_CATEGORIES, MonAmiException, SequentialAmi, TokenBufferedSocket)
+from monamish import amiaddr_to_dict
+
+
+def dict_to_message(dict):
+    """
+    Serialize an AMI dictionary (as passed to on_dict()) back to bytes. The
+    Command output in dict[''] is written the way it came in: raw, ending
+    with --END COMMAND-- after a Response: Follows, otherwise as Output
+    headers (Asterisk 14+).
+    """
+    msg = [('%s: %s\r\n' % (k, v)).encode('utf-8')
+           for k, v in dict.items() if k != '']
+    if '' in dict and dict.get('Response') == 'Follows':
+        msg.append(dict[''].encode('utf-8') + b'--END COMMAND--\r\n')
+    elif '' in dict:
+        msg.extend(('Output: %s\r\n' % (line,)).encode('utf-8')
+                   for line in dict[''].split('\n')[:-1])
+    msg.append(b'\r\n')
+    return b''.join(msg)
+
+
+# Asterisk filters are POSIX extended regular expressions. Python re has
+# no character classes; these are their contents in a bracket expression.
+POSIX_CLASSES = {
+    'alnum': r'0-9A-Za-z', 'alpha': r'A-Za-z', 'blank': r' \t',
+    'cntrl': r'\x00-\x1f\x7f', 'digit': r'0-9', 'graph': r'\x21-\x7e',
+    'lower': r'a-z', 'print': r'\x20-\x7e', 'punct': r'!-/:-@\[-`{-~',
+    'space': r'\s', 'upper': r'A-Z', 'xdigit': r'0-9A-Fa-f',
+}
+POSIX_CLASS_RE = re.compile(r'\[:([a-z]+):\]')
+ASTERISK_TRUE = ('yes', 'true', 'y', 't', '1', 'on')
+ASTERISK_FALSE = ('no', 'false', 'n', 'f', '0', 'off', '')
+
+
+def posix_to_regex(pattern):
+    """
+    Translate a POSIX extended regex (as used in AMI Filters) to a Python
+    re pattern: replace the [:space:] style character classes.
+    """
+    def replace(match):
+        try:
+            return POSIX_CLASSES[match.group(1)]
+        except KeyError:
+            raise re.error('unknown character class %r' % (match.group(),))
+    return POSIX_CLASS_RE.sub(replace, pattern)
+
+
+def mask_to_categories(mask):
+    """
+    Parse an Events: or EventMask: value the way Asterisk does. Returns
+    None for all events, otherwise the set of categories (empty for none).
+    """
+    mask = mask.strip().lower()
+    if mask in ASTERISK_TRUE:
+        return None
+    elif mask in ASTERISK_FALSE:
+        return set()
+    elif mask.isdigit():
+        return None  # a numeric bitmask; we don't know the bits
+    categories = set(i.strip() for i in mask.split(',')) - set([''])
+    return None if 'all' in categories else categories
+
+
+def event_categories(dict):
+    """
+    Return the categories of an event: those in its Privilege header
+    (Asterisk adds it to every event), or those from EVENT_CATEGORIES.
+    Returns None if we don't know them.
+    """
+    privilege = dict.get('Privilege')
+    if privilege:
+        return set(i.strip() for i in privilege.lower().split(',')) - set([
+            'all', ''])
+    for category, category_events in EVENT_CATEGORIES.items():
+        if dict.get('Event') in category_events:
+            return set([category])
+    return None
+
+
+class ProxyUpstreamAmi(SequentialAmi):
+    """
+    The upstream session. Everything that is not a response to one of our
+    own actions (login, events, ping) is handed to the proxy.
+    """
+    def __init__(self, proxy, **kwargs):
+        kwargs['disconnect_mode'] = SequentialAmi.DIS_NEVER
+        kwargs.setdefault('keepalive', 60)
+        super(ProxyUpstreamAmi, self).__init__(**kwargs)
+        self._proxy = proxy
+        self.add_action('Events', {'EventMask': 'on'})
+
+    def on_unexpected(self, dict):
+        self._proxy.on_upstream_dict(dict)
+
+
+class ProxyClient(object):
+    """
+    A downstream AMI client connected to the proxy.
+    """
+    max_output_size = 4 * 1024 * 1024  # drop clients that can't keep up
+
+    def __init__(self, proxy, sock, address):
+        self.address = address
+        self.username = None
+        self.events = None  # categories we want, None for all
+        self.filters = []  # list of (compiled regex, negate)
+        self._proxy = proxy
+        self._lines = []
+        self._challenge = None
+        self.sock = TokenBufferedSocket(token=b'\r\n', on_data=self._on_line)
+        self.sock.attach(sock)
+        self.sock.write(b'Asterisk Call Manager/1.3\r\n')
+
+    def wants(self, message, categories):
+        """
+        Check the event categories (see event_categories()) against the
+        Events mask and the serialized event against the filters. Like in
+        Asterisk: all categories must be in the mask; if there are
+        whitelist filters, one must match; no blacklist filter (prefixed
+        with an exclamation mark) may match.
+        """
+        if not self.username:
+            return False
+        if self.events is not None and (
+                categories is None or not categories or
+                not categories <= self.events):
+            return False
+        whitelisted = None
+        for regex, negate in self.filters:
+            if negate:
+                if regex.search(message):
+                    return False
+            elif not whitelisted:
+                whitelisted = bool(regex.search(message))
+        return whitelisted is not False
+
+    def write(self, message):
+        if self.sock.output_size() > self.max_output_size:
+            self.sock.abort()
+        elif self.sock.fileno() is not None:
+            self.sock.write(message)
+
+    def reply(self, action_id, response, **kwargs):
+        dict = {'Response': response}
+        if action_id is not None:
+            dict['ActionID'] = action_id
+        dict.update(kwargs)
+        self.write(dict_to_message(dict))
+
+    def _on_line(self, data):
+        if data == b'\r\n':
+            if self._lines:
+                lines, self._lines = self._lines, []
+                self._on_action(lines)
+        elif data.endswith(b'\r\n'):
+            self._lines.append(data)
+        # Else: EOF without a complete message. Drop it.
+
+    def _on_action(self, lines):
+        parameters = {}
+        for line in lines:
+            key, sep, value = line.partition(b':')
+            if sep:
+                parameters[key.strip().decode('ascii', 'replace')] = (
+                    value.strip().decode('utf-8', 'replace'))
+        action = parameters.get('Action', '').lower()
+        action_id = parameters.get('ActionID')
+
+        if action == 'challenge':
+            self._challenge = str(random.randint(100000000, 999999999))
+            self.reply(action_id, 'Success', Challenge=self._challenge)
+        elif action == 'login':
+            self._on_login(parameters, action_id)
+        elif action == 'logoff':
+            self.reply(action_id, 'Goodbye',
+                       Message='Thanks for all the fish.')
+            self.sock.write(b'', shutdown_when_written=True)
+        elif not self.username:
+            self.reply(action_id, 'Error', Message='Authentication Required')
+        elif action == 'ping':
+            self.reply(action_id, 'Success', Ping='Pong',
+                       Timestamp='%f' % (time.time(),))
+        elif action == 'events':
+            self.events = mask_to_categories(
+                parameters.get('EventMask', 'on'))
+            self.reply(action_id, 'Success',
+                       Events='Off' if self.events == set() else 'On')
+        elif action == 'filter':
+            self._on_filter(parameters, action_id)
+        else:
+            self._proxy.forward(self, parameters)
+
+    def _on_login(self, parameters, action_id):
+        username = parameters.get('Username', '')
+        secret = self._proxy.users.get(username)
+        if secret is None:
+            ok = False
+        elif parameters.get('AuthType', '').lower() == 'md5':
+            ok = bool(self._challenge) and parameters.get('Key') == md5(
+                (self._challenge + secret).encode('utf-8')).hexdigest()
+        else:
+            ok = parameters.get('Secret') == secret
+        if not ok:
+            self.reply(action_id, 'Error', Message='Authentication failed')
+            self.sock.write(b'', shutdown_when_written=True)
+            return
+        self.username = username
+        self.events = mask_to_categories(parameters.get('Events', 'on'))
+        self.reply(action_id, 'Success', Message='Authentication accepted')
+
+    def _on_filter(self, parameters, action_id):
+        operation = parameters.get('Operation', 'Add').lower()
+        filter = parameters.get('Filter', '')
+        if operation != 'add' or not filter:
+            self.reply(action_id, 'Error', Message='Filter Not Supported')
+            return
+        negate = filter.startswith('!')
+        try:
+            # Filters are matched against the serialized event, like the
+            # Asterisk filters are.
+            regex = re.compile(posix_to_regex(
+                filter[1:] if negate else filter).encode('utf-8'))
+        except re.error:
+            self.reply(action_id, 'Error', Message='Filter Not Valid')
+            return
+        self.filters.append((regex, negate))
+        self.reply(action_id, 'Success', Message='Filter Added Successfully')
+
+
+class AmiProxy(object):
+    """
+    Listen for downstream AMI clients on a local port and multiplex them
+    over a single upstream SequentialAmi session.
+
+    Example usage::
+
+        proxy = AmiProxy(
+            upstream=amiaddr_to_dict('proxy:secret@pbx1'),
+            listen=('127.0.0.1', 5039),
+            users={'wallboard': 'pass1', 'crm': 'pass2'})
+        proxy.serve_forever()
+    """
+    reconnect_interval = 5
+
+    def __init__(self, upstream, listen, users):
+        self.users = users
+        self._upstream_kwargs = dict(upstream)
+        self._upstream_kwargs.setdefault('auth', 'md5')
+        self._upstream = None
+        self._next_connect = 0
+        self._clients = {}  # fileno => ProxyClient
+        self._routes = {}   # upstream ActionID => (client, ActionID)
+        self._action_id = 0
+        self._action_id_prefix = 'proxy-%f-' % (time.time(),)
+        self._running = True
+        self._tick = 0
+        self._tick_interval = TokenBufferedSocket.select_timeout
+
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(listen)
+        self._listener.listen(64)
+        self._listener.setblocking(0)
+
+    def address(self):
+        """
+        Return the (host, port) we're listening on.
+        """
+        return self._listener.getsockname()
+
+    def close(self):
+        """
+        Stop serve_forever(). Thread-safe, in the sense that the loop exits
+        the next time it wakes up.
+        """
+        self._running = False
+
+    def serve_forever(self):
+        try:
+            while self._running:
+                self.work()
+        finally:
+            for client in list(self._clients.values()):
+                client.sock.abort()
+            if self._upstream:
+                self._upstream.close()
+            self._listener.close()
+
+    def forward(self, client, parameters):
+        """
+        Send the action of client upstream, with our own ActionID.
+        """
+        action_id = parameters.pop('ActionID', None)
+        if not self._upstream or not self._upstream.is_authenticated():
+            client.reply(action_id, 'Error', Message='Upstream not connected')
+            return
+        self._action_id += 1
+        upstream_id = self._action_id_prefix + str(self._action_id)
+        parameters['ActionID'] = upstream_id
+        self._routes[upstream_id] = (client, action_id)
+        self._upstream.send(parameters)
+
+    def on_upstream_dict(self, dict):
+        upstream_id = dict.get('ActionID')
+        route = self._routes.get(upstream_id)
+        if route:
+            client, action_id = route
+            if action_id is None:
+                del dict['ActionID']
+            else:
+                dict['ActionID'] = action_id
+            client.write(dict_to_message(dict))
+
+            # Keep the route around as long as a list of events follows.
+            if dict.get('Event'):
+                done = (dict.get('EventList', '').lower() == 'complete' or
+                        dict['Event'].endswith('Complete'))
+            else:
+                done = not (
+                    dict.get('EventList', '').lower() == 'start' or
+                    'will follow' in dict.get('Message', ''))
+            if done:
+                del self._routes[upstream_id]
+
+        elif upstream_id and upstream_id.startswith(self._action_id_prefix):
+            pass  # the client is gone
+
+        elif dict.get('Event'):
+            # Serialize once, fan out to all interested clients.
+            message = dict_to_message(dict)
+            categories = event_categories(dict)
+            for client in list(self._clients.values()):
+                if client.wants(message, categories):
+                    client.write(message)
+
+    def work(self):
+        if not self._upstream and time.time() >= self._next_connect:
+            self._connect_upstream()
+        for fd, client in list(self._clients.items()):
+            if client.sock.fileno() is None:
+                self._drop_client(fd)
+
+        rlist, wlist = [self._listener], []
+        upstream_fd = self._upstream and self._upstream.fileno()
+        if upstream_fd is not None:
+            rlist.append(upstream_fd)
+            if self._upstream.has_output():
+                wlist.append(upstream_fd)
+        for fd, client in self._clients.items():
+            rlist.append(fd)
+            if client.sock.has_output():
+                wlist.append(fd)
+
+        timeout = max(0, self._tick + self._tick_interval - time.time())
+        rlist, wlist, xlist = select.select(rlist, wlist, (), timeout)
+        ready = set(rlist + wlist)
+
+        if self._listener in ready:
+            self._accept()
+
+        for fd in ready:
+            client = self._clients.get(fd)
+            if client:
+                self._work_client(fd, client)
+
+        # The upstream also gets work every tick, for its alarms.
+        if time.time() >= self._tick + self._tick_interval:
+            self._tick = time.time()
+            ready.add(upstream_fd)
+        if self._upstream and upstream_fd in ready:
+            try:
+                self._upstream.work(0)
+            except Exception as e:
+                self._drop_upstream(e)
+
+        # Writes queued during this round go out right away.
+        if self._upstream and self._upstream.has_output():
+            try:
+                self._upstream.work(0)
+            except Exception as e:
+                self._drop_upstream(e)
+        for fd, client in list(self._clients.items()):
+            if client.sock.has_output():
+                self._work_client(fd, client)
+
+    def _work_client(self, fd, client):
+        # A client resetting its connection must only take itself down.
+        try:
+            if client.sock.work(0) is not None:
+                return
+        except socket.error:
+            pass
+        self._drop_client(fd)
+
+    def _accept(self):
+        try:
+            sock, address = self._listener.accept()
+        except socket.error:
+            return
+        client = ProxyClient(self, sock, address)
+        self._clients[client.sock.fileno()] = client
+
+    def _connect_upstream(self):
+        self._next_connect = time.time() + self.reconnect_interval
+        try:
+            self._upstream = ProxyUpstreamAmi(self, **self._upstream_kwargs)
+        except MonAmiException as e:
+            sys.stderr.write('monamiproxy: %s\n' % (e,))
+
+    def _drop_upstream(self, error):
+        sys.stderr.write('monamiproxy: upstream: %s\n' % (error,))
+        self._upstream.close()
+        self._upstream = None
+        # Tell the clients that their pending actions are lost.
+        for client, action_id in self._routes.values():
+            client.reply(action_id, 'Error', Message='Upstream disconnected')
+        self._routes = {}
+
+    def _drop_client(self, fd):
+        client = self._clients.pop(fd)
+        client.sock.abort()
+        self._routes = dict(
+            (k, v) for k, v in self._routes.items() if v[0] is not client)
+
+
+def main():
+    port, upstream, users = sys.argv[1], sys.argv[2], sys.argv[3:]
+    if not users:
+        raise ValueError('Use the source, Luke')
+    proxy = AmiProxy(
+        upstream=amiaddr_to_dict(upstream),
+        listen=('127.0.0.1', int(port)),
+        users=dict(user.split(':', 1) for user in users))
+    proxy.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,17 +2,49 @@
 # vim: set ts=8 sw=4 sts=4 et ai tw=79:
 '''
 FIXME/XXX: Shortcuts for monami. Document me.
+
+Run "monamish daemon /path/to/socket HOSTS..." to keep the sessions open,
+and then use "unix:/path/to/socket" as the only host for the command,
+queuestatus, queuesummary and reload commands.
+
+Run "monamish listen events=Hangup,Newchannel HOSTS..." to have the
+asterisken only send the listed events. Add sink=SPEC to write the events
+as JSON lines to stdout, rotated files or a UNIX datagram socket; see
+monamisink.
+
+Run "monamish rollingreload MAXPARALLEL CANARY maxfailurerate=RATE
+HOSTS..." to reload at most MAXPARALLEL hosts at a time, the first CANARY
+hosts first, and to stop starting new hosts once more than RATE (0..1) of
+them have failed.
+
+Run "monamish queuesummary QUEUE minhosts=N tail=SECONDS HOSTS..." to get
+the results as soon as N hosts have answered (and SECONDS have passed);
+the hosts that are left out are listed as missing.
 '''
+import json
+import os
+import socket
+import socketserver
+import stat
 import sys
+import threading
+import time
 
 from collections import defaultdict
+from concurrent.futures import Future
 try:
     from urllib.parse import urlparse
 except ImportError:
     from urlparse import urlparse
 
 # Local friend package.
-from monami import MultiHostSequentialAmi, SequentialAmi
+from monami import (
+    BackgroundAmi, EventMerger, MonAmiFinished, MonAmiTimeout,
+    MultiHostSequentialAmi, SequentialAmi, TokenBufferedSocket, ready_amis)
+from monamisink import make_sink
+
+# The commands that make up a reload.
+RELOAD_COMMANDS = ('dialplan reload', 'module reload func_odbc', 'sip reload')
 
 
 def amiaddr_to_dict(address):
@@ -53,12 +85,168 @@ def channel_originate(ami_kwarg, channel, params=None):
     s.process()
 
 
-def cli_asterisken(ami_kwargs, command):
+class _BulkOriginateAmi(SequentialAmi):
+    """
+    SequentialAmi that hands the Originate responses and the events to the
+    BulkOriginate, instead of matching them against the action queue. That
+    way a failing Originate does not abort the session.
+    """
+    def __init__(self, bulk, **kwargs):
+        super(_BulkOriginateAmi, self).__init__(**kwargs)
+        self._bulk = bulk
+
+    def on_unexpected(self, dict):
+        self._bulk._on_dict(dict)
+
+
+class BulkOriginate(object):
+    """
+    Originate lots of calls over a single AMI session.
+
+    Calls are sent with Async: true, at most calls_per_second (a token
+    bucket with room for burst calls) and with at most max_channels calls
+    in progress. A call is in progress until its OriginateResponse failed
+    or until the originated channel is hung up (or has been up for
+    max_channel_time seconds, in case we missed the Hangup).
+
+    Example usage::
+
+        def on_result(result):
+            print(result['spec']['Channel'], result['success'],
+                  result['reason'], result['latency'])
+
+        b = BulkOriginate(amiaddr_to_dict('user:pass@pbx1'),
+                          calls_per_second=2, max_channels=30)
+        summary = b.run(specs, on_result)
+
+    The specs are Originate parameters dicts, read lazily from any iterable.
+    The results passed to on_result() are dicts with: spec, success, reason
+    (the OriginateResponse Reason or an error message), uniqueid and
+    latency (seconds from sending the Originate until the
+    OriginateResponse). run() returns a summary dict with the success and
+    failure counts and the average latency.
+    """
+    response_timeout = 60
+    max_channel_time = 4 * 3600
+
+    def __init__(self, ami_kwarg, calls_per_second=1.0, max_channels=10,
+                 burst=1):
+        self._ami_kwarg = dict(ami_kwarg)
+        self._ami_kwarg.setdefault('auth', 'md5')
+        self._ami_kwarg.setdefault('keepalive', 60)
+        self.calls_per_second = calls_per_second
+        self.max_channels = max_channels
+        self.burst = burst
+        self._pending = {}   # ActionID => (spec, sent time)
+        self._channels = {}  # Uniqueid => answer time, for answered calls
+        self._action_id = 0
+        self._action_id_prefix = 'orig-%f-' % (time.time(),)
+
+    def run(self, specs, on_result=None):
+        self._on_result = on_result
+        self._summary = {'success': 0, 'failure': 0, 'latency': 0.0}
+        ami = _BulkOriginateAmi(
+            self, disconnect_mode=SequentialAmi.DIS_NEVER,
+            events=['OriginateResponse', 'Hangup'], **self._ami_kwarg)
+        try:
+            self._run(ami, iter(specs))
+        finally:
+            ami.close()
+
+        summary = self._summary
+        done = summary['success'] + summary['failure']
+        summary['latency'] = (summary['latency'] / done) if done else 0.0
+        return summary
+
+    def _run(self, ami, specs):
+        tokens, t0 = float(self.burst), time.time()
+        spec = next(specs, None)
+        while spec is not None or self._pending or self._channels:
+            if not ami.is_authenticated():
+                ami.work()
+                t0 = time.time()
+                continue
+
+            # Refill the token bucket.
+            now = time.time()
+            tokens = min(float(self.burst),
+                         tokens + (now - t0) * self.calls_per_second)
+            t0 = now
+
+            while (spec is not None and tokens >= 1 and
+                   len(self._pending) + len(self._channels) <
+                   self.max_channels):
+                self._originate(ami, spec)
+                tokens -= 1
+                spec = next(specs, None)
+
+            for action_id, (pending, sent) in list(self._pending.items()):
+                if now - sent > self.response_timeout:
+                    del self._pending[action_id]
+                    self._result(pending, False, 'No OriginateResponse',
+                                 None, now - sent)
+            for uniqueid, answered in list(self._channels.items()):
+                if now - answered > self.max_channel_time:
+                    del self._channels[uniqueid]  # missed its Hangup
+
+            timeout = None
+            if spec is not None and tokens < 1:
+                timeout = min(0.333,
+                              (1 - tokens) / float(self.calls_per_second))
+            ami.work(timeout)
+
+    def _originate(self, ami, spec):
+        self._action_id += 1
+        action_id = self._action_id_prefix + str(self._action_id)
+        parameters = dict(spec)
+        parameters.update({
+            'Action': 'Originate', 'ActionID': action_id, 'Async': 'true'})
+        self._pending[action_id] = (spec, time.time())
+        ami.send(parameters)
+
+    def _on_dict(self, dict):
+        event = dict.get('Event')
+        if event == 'Hangup':
+            self._channels.pop(dict.get('Uniqueid'), None)
+            return
+
+        pending = self._pending.get(dict.get('ActionID'))
+        if not pending:
+            return
+        spec, sent = pending
+        if event == 'OriginateResponse':
+            del self._pending[dict['ActionID']]
+            success = dict.get('Response') == 'Success'
+            uniqueid = dict.get('Uniqueid')
+            if success and uniqueid:
+                self._channels[uniqueid] = time.time()
+            self._result(spec, success, dict.get('Reason'), uniqueid,
+                         time.time() - sent)
+        elif not event and dict.get('Response') != 'Success':
+            # The Originate was refused right away.
+            del self._pending[dict['ActionID']]
+            self._result(spec, False, dict.get('Message'), None,
+                         time.time() - sent)
+
+    def _result(self, spec, success, reason, uniqueid, latency):
+        self._summary['success' if success else 'failure'] += 1
+        self._summary['latency'] += latency
+        if self._on_result:
+            self._on_result({'spec': spec, 'success': success,
+                             'reason': reason, 'uniqueid': uniqueid,
+                             'latency': latency})
+
+
+def cli_asterisken(ami_kwargs, command, on_output=None):
     """
     Provide a CLI command directly. Potentially dangerous!
 
     Example command: 'dialplan reload' or 'sip show peers'
     Returns: (list of output tuples, list of error tuples)
+
+    If on_output is supplied, the output is not collected, but passed to
+    on_output(line, input) line by line as it arrives. The returned output
+    list will be empty.
     """
     data = []
 
@@ -67,10 +255,12 @@ def cli_asterisken(ami_kwargs, command):
         # is. Should we alter monami to pass the host to the callback
         # as well? Or the MultiHostSequentialAmi to wrap our callback
         # with one that passed the amiaddr too.
-        data.append(dict.get('', '(void)'))
+        if not on_output:
+            data.append(dict.get('', '(void)'))
 
     s = MultiHostSequentialAmi()
-    s.add_action('Command', {'Command': command}, callback)
+    s.add_action('Command', {'Command': command}, callback,
+                 on_output=on_output)
     for ami_kwarg in ami_kwargs:
         s.add_connection(**ami_kwarg)
 
@@ -85,9 +275,8 @@ def reload_asterisken(ami_kwargs):
     failure count.
     """
     s = MultiHostSequentialAmi()
-    s.add_action('Command', {'Command': 'dialplan reload'})
-    s.add_action('Command', {'Command': 'module reload func_odbc'})
-    s.add_action('Command', {'Command': 'sip reload'})
+    for command in RELOAD_COMMANDS:
+        s.add_action('Command', {'Command': command})
     for ami_kwarg in ami_kwargs:
         s.add_connection(**ami_kwarg)
 
@@ -95,16 +284,127 @@ def reload_asterisken(ami_kwargs):
     return errors  # a list of error tuples [(ami_kwarg, error), ...]
 
 
-def _fetch_eventinfo(ami_kwargs, command, params, end_event):
+def rolling_reload_asterisken(ami_kwargs, max_parallel=10, canary=0,
+                              max_failure_rate=None, host_timeout=60,
+                              on_result=None):
+    """
+    Reload the asterisk config (see reload_asterisken()), but on at most
+    max_parallel hosts at the same time, so e.g. the shared func_odbc
+    database doesn't get hit by all of them at once.
+
+    If canary is set, the first canary hosts are reloaded first, and the
+    rest is only started if they all succeeded. If max_failure_rate (0..1)
+    is set, no new hosts are started once the fraction of failed hosts
+    exceeds it.
+
+    Returns (list of results, list of skipped ami_kwargs). Each result is
+    a dict with the ami_kwarg, the error (or None), the total duration and
+    a list of (step, seconds) timings: connect, login and every reload
+    command. If you pass on_result, it is called with every result as soon
+    as it is available.
+    """
+    todo = list(ami_kwargs)
+    results, active = [], []
+    stats = {'done': 0, 'failed': 0}
+
+    def start(ami_kwarg):
+        result = {'ami_kwarg': ami_kwarg, 'error': None, 'duration': 0.0,
+                  'timings': []}
+        t0 = time.time()
+        try:
+            ami = SequentialAmi(**ami_kwarg)
+        except Exception as e:
+            finish(result, t0, e)
+            return
+        marks = {'t0': t0, 'last': time.time(), 'logged_in': False}
+        result['timings'].append(('connect', marks['last'] - t0))
+
+        def callback(dict, input):
+            now = time.time()
+            result['timings'].append((input['Command'], now - marks['last']))
+            marks['last'] = now
+
+        for command in RELOAD_COMMANDS:
+            ami.add_action('Command', {'Command': command}, callback)
+        active.append((ami, result, marks))
+
+    def finish(result, t0, error=None):
+        result['error'] = error
+        result['duration'] = time.time() - t0
+        results.append(result)
+        stats['done'] += 1
+        if error:
+            stats['failed'] += 1
+        if on_result:
+            on_result(result)
+
+    def work(ami, result, marks):
+        try:
+            ami.work(0)
+            if not marks['logged_in'] and ami.is_authenticated():
+                now = time.time()
+                result['timings'].append(('login', now - marks['last']))
+                marks['last'], marks['logged_in'] = now, True
+            if time.time() - marks['t0'] > host_timeout:
+                raise MonAmiTimeout('Reload took more than %ds' % (
+                    host_timeout,))
+        except MonAmiFinished:
+            finish(result, marks['t0'])
+        except Exception as e:
+            ami.close()
+            finish(result, marks['t0'], e)
+        else:
+            return
+        active.remove((ami, result, marks))
+
+    def stop():
+        if canary and stats['done'] <= canary and stats['failed']:
+            return True
+        return bool(
+            max_failure_rate is not None and stats['done'] and
+            float(stats['failed']) / stats['done'] > max_failure_rate)
+
+    # Canary batch: these must all succeed.
+    batch_size = len(todo) if not canary else min(canary, len(todo))
+    tick, tick_interval = time.time(), TokenBufferedSocket.select_timeout
+    while todo or active:
+        while (todo and not stop() and len(active) < max_parallel and
+               len(results) + len(active) < batch_size):
+            start(todo.pop(0))
+        if not active:
+            if stop() or not todo:
+                break
+            batch_size = len(results) + len(todo)  # canaries passed
+            continue
+
+        amis = [item[0] for item in active]
+        ready = ready_amis(amis, max(0, tick + tick_interval - time.time()))
+        if time.time() >= tick + tick_interval:
+            tick = time.time()
+            ready = amis  # every one of them gets work every tick
+        for item in [item for item in active if item[0] in ready]:
+            work(*item)
+
+    return results, todo
+
+
+def _fetch_eventinfo(ami_kwargs, command, params, end_event,
+                     min_hosts=None, tail_timeout=0):
     """
     Shortcut for getting a single event between a start-event and end-event.
+
+    If min_hosts is set, this returns tail_timeout seconds after that many
+    hosts have answered; see MultiHostSequentialAmi. The partial results of
+    the other hosts are dropped. Returns the data and the list of hosts
+    without a complete answer: the ones that didn't make it in time, failed
+    to connect or failed halfway.
     """
     data = []
 
     def callback(dict, input):
         data.append((dict, input))
 
-    s = MultiHostSequentialAmi()
+    s = MultiHostSequentialAmi(min_hosts=min_hosts, tail_timeout=tail_timeout)
     s.add_action('Events', {'EventMask': 'on'})
     s.add_action(command, params, callback, end_event)
     for ami_kwarg in ami_kwargs:
@@ -116,19 +416,101 @@ def _fetch_eventinfo(ami_kwargs, command, params, end_event):
     if not success_count:
         raise ValueError('Command failed on all asterisken')
 
-    return data
+    data = [(dict, input) for dict, input in data
+            if input['ActionID'] not in s.missing_action_ids]
+    missing = ['%(host)s:%(port)s' % ami_kwarg for ami_kwarg, e in errors]
+    return data, missing
 
 
-def fetch_queuestatus(ami_kwargs, queue_id):
-    data = _fetch_eventinfo(ami_kwargs, 'QueueStatus', {'Queue': queue_id},
-                            'QueueStatusComplete')
-    return translate_queuestatus(data)
+class _ListenAmi(SequentialAmi):
+    """
+    SequentialAmi that hands its events to an EventMerger.
+    """
+    def __init__(self, merger, name, **kwargs):
+        super(_ListenAmi, self).__init__(**kwargs)
+        self._merger = merger
+        self._name = name
+
+    def on_unexpected(self, dict):
+        self._merger.push(self._name, dict)
+
+
+def listen_asterisken(ami_kwargs, on_event, events=None, window=1.0):
+    """
+    Listen for events on all hosts, and pass them to on_event(when, host,
+    received, dict) in time order; see monami.EventMerger. If events is
+    set, only those events are requested (see SequentialAmi).
+
+    Returns when all connections are gone, with a list of error tuples
+    [(ami_kwarg, error), ...].
+    """
+    merger = EventMerger(window=window)
+    amis, errors = [], []
+    for ami_kwarg in ami_kwargs:
+        kwargs = {'auth': 'md5', 'keepalive': 10, 'events': events}
+        kwargs.update(ami_kwarg)
+        kwargs['disconnect_mode'] = SequentialAmi.DIS_NEVER
+        try:
+            ami = _ListenAmi(merger, ami_kwarg['host'], **kwargs)
+        except Exception as e:
+            errors.append((ami_kwarg, e))
+            continue
+        if not events:
+            ami.add_action('events', {'EventMask': 'on'})
+        amis.append((ami_kwarg, ami))
+
+    tick, tick_interval = time.time(), TokenBufferedSocket.select_timeout
+    while amis:
+        ready = ready_amis(
+            [ami for ami_kwarg, ami in amis],
+            max(0, tick + tick_interval - time.time()))
+        if time.time() >= tick + tick_interval:
+            tick = time.time()
+            ready = [ami for ami_kwarg, ami in amis]
+        for ami_kwarg, ami in list(amis):
+            if ami not in ready:
+                continue
+            try:
+                ami.work(0)
+            except Exception as e:
+                errors.append((ami_kwarg, e))
+                amis.remove((ami_kwarg, ami))
+        for event in merger.pop(flush=not amis):
+            on_event(*event)
+
+    return errors
+
+
+def fetch_queuestatus(ami_kwargs, queue_id, min_hosts=None,
+                      tail_timeout=0):
+    """
+    Return the combined queue status of all hosts. If min_hosts is set,
+    don't wait for the slowest hosts (see _fetch_eventinfo); the ones
+    that are left out are listed in the 'missing' item.
+    """
+    data, missing = _fetch_eventinfo(
+        ami_kwargs, 'QueueStatus', {'Queue': queue_id},
+        'QueueStatusComplete', min_hosts=min_hosts, tail_timeout=tail_timeout)
+    ret = translate_queuestatus(data)
+    if min_hosts is not None:
+        ret['missing'] = missing
+    return ret
 
 
-def fetch_queuesummary(ami_kwargs, queue_id):
-    data = _fetch_eventinfo(ami_kwargs, 'QueueSummary', {'Queue': queue_id},
-                            'QueueSummaryComplete')
-    return translate_queuesummary(data)
+def fetch_queuesummary(ami_kwargs, queue_id, min_hosts=None,
+                       tail_timeout=0):
+    """
+    Return the combined queue summary of all hosts; see
+    fetch_queuestatus() for min_hosts.
+    """
+    data, missing = _fetch_eventinfo(
+        ami_kwargs, 'QueueSummary', {'Queue': queue_id},
+        'QueueSummaryComplete', min_hosts=min_hosts,
+        tail_timeout=tail_timeout)
+    ret = translate_queuesummary(data)
+    if min_hosts is not None:
+        ret['missing'] = missing
+    return ret
 
 
 def translate_queuestatus(queue_data):
@@ -200,18 +582,286 @@ def translate_queuesummary(queue_data):
     return ret
 
 
+class MonamishDaemon(object):
+    """
+    Keep authenticated AMI sessions to a set of hosts and answer queries
+    over a local UNIX socket. See main() for the command line interface.
+
+    The protocol is one JSON object per connection: the client sends
+    {"command": "queuesummary", "args": ["22"]} and a newline, the daemon
+    replies with {"result": ..., "errors": [[host, error], ...]} and closes
+    the connection. Concurrent identical queries are coalesced: they are
+    sent to the hosts only once and all clients get the same reply.
+    """
+    query_timeout = 5
+    reconnect_interval = 30
+
+    def __init__(self, ami_kwargs):
+        self._ami_kwargs = dict(
+            ('%(host)s:%(port)s' % ami_kwarg, ami_kwarg)
+            for ami_kwarg in ami_kwargs)
+        self._ami = BackgroundAmi()
+        self._connect_times = {}
+        self._connect_lock = threading.Lock()
+        self._inflight_lock = threading.Lock()
+        self._inflight = {}  # (command, args) => Future
+        self._ami.start()
+
+    def close(self):
+        self._ami.close()
+
+    def query(self, command, args):
+        """
+        Run the query, or wait for the identical query that is already
+        running. Returns a (result, errors) tuple. Thread-safe.
+        """
+        key = (command, tuple(args))
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if owner:
+            try:
+                future.set_result(self._query(command, args))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._inflight_lock:
+                    del self._inflight[key]
+        return future.result()
+
+    def fetch(self, actions):
+        """
+        Run the actions, a list of (action, parameters, stop_event), on all
+        hosts at once, and wait for them with a single deadline of
+        query_timeout seconds. Returns (results, errors): results is a list
+        of (host, index in actions, parameters, response, events) of the
+        completed actions, errors a list of (host, error) tuples, one per
+        host that did not complete them all. Thread-safe.
+        """
+        names, errors = self._connect()
+        futures = []
+        for name in names:
+            for index, (action, parameters, stop_event) in enumerate(actions):
+                parameters = dict(parameters)
+                futures.append((name, index, parameters, self._ami.add_action(
+                    name, action, parameters, stop_event)))
+
+        deadline = time.time() + self.query_timeout
+        results, failed = [], set()
+        for name, index, parameters, future in futures:
+            try:
+                response, events = future.result(
+                    max(0, deadline - time.time()))
+            except Exception as e:
+                if name not in failed:
+                    failed.add(name)
+                    errors.append((name, str(e) or e.__class__.__name__))
+                continue
+            results.append((name, index, parameters, response, events))
+        return results, errors
+
+    def _query(self, command, args):
+        if command == 'command':
+            actions = [('Command', {'Command': args[0]}, None)]
+        elif command == 'reload':
+            actions = [('Command', {'Command': i}, None)
+                       for i in RELOAD_COMMANDS]
+        elif command == 'queuestatus':
+            actions = [('QueueStatus', {'Queue': args[0]},
+                        'QueueStatusComplete')]
+        elif command == 'queuesummary':
+            actions = [('QueueSummary', {'Queue': args[0]},
+                        'QueueSummaryComplete')]
+        else:
+            raise ValueError('unknown command %r' % (command,))
+
+        results, errors = self.fetch(actions)
+        data, outputs = [], {}
+        for name, index, parameters, response, events in results:
+            data.append((response, parameters))
+            data.extend((event, parameters) for event in events)
+            outputs[name] = outputs.get(name, '') + response.get('', '')
+
+        if command == 'command':
+            result = outputs
+        elif command == 'reload':
+            # The hosts that are connected and completed all commands.
+            result = len(self._ami_kwargs) - len(errors)
+        elif command == 'queuestatus':
+            result = translate_queuestatus(data)
+        else:
+            result = translate_queuesummary(data)
+        return result, errors
+
+    def _connect(self):
+        """
+        (Re)connect to the hosts that are not connected. Returns the list of
+        connected host names and a list of (name, error) tuples.
+        """
+        errors = []
+        with self._connect_lock:
+            alive = self._ami.connections()
+            for name, ami_kwarg in sorted(self._ami_kwargs.items()):
+                if name in alive:
+                    continue
+                if (time.time() - self._connect_times.get(name, 0) <
+                        self.reconnect_interval):
+                    errors.append((name, 'not connected'))
+                    continue
+                self._connect_times[name] = time.time()
+                kwargs = {'auth': 'md5', 'keepalive': 60}
+                kwargs.update(ami_kwarg)
+                try:
+                    self._ami.add_connection(name=name, **kwargs)
+                except Exception as e:
+                    errors.append((name, str(e)))
+            alive = self._ami.connections()
+        return sorted(alive), errors
+
+    def serve(self, path):
+        """
+        Listen on the UNIX socket path and serve queries forever.
+        """
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline().decode('utf-8'))
+                    result, errors = daemon.query(
+                        request['command'], request.get('args', []))
+                    reply = {'result': result, 'errors': errors}
+                except Exception as e:
+                    reply = {'error': str(e)}
+                self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+        class Server(socketserver.ThreadingUnixStreamServer):
+            daemon_threads = True
+
+        _remove_stale_socket(path)
+        server = Server(path, Handler)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+def _remove_stale_socket(path):
+    # A daemon that was killed leaves its socket file behind, and then the
+    # bind fails. Only remove it if nobody is listening on it anymore.
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return  # not ours, let the bind fail
+    except OSError:
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        os.unlink(path)
+    finally:
+        sock.close()
+
+
+def daemon_query(path, command, args, timeout=30):
+    """
+    Send a query to a MonamishDaemon listening on the UNIX socket path.
+    Returns a (result, errors) tuple. Raises ValueError if the daemon could
+    not handle the query.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(
+            {'command': command, 'args': args}).encode('utf-8') + b'\n')
+        data = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data.append(chunk)
+    finally:
+        sock.close()
+
+    reply = json.loads(b''.join(data).decode('utf-8'))
+    if 'error' in reply:
+        raise ValueError(reply['error'])
+    return reply['result'], [tuple(error) for error in reply['errors']]
+
+
 def main():
     # What did the user want?
     command, args = ''.join(sys.argv[1:2]), sys.argv[2:]
     if command == 'originate':
         (channel, context, exten), args = args[0:3], args[3:]
-    elif command in ('listen', 'reload'):
+    elif command == 'bulkoriginate':
+        calls_per_second, max_channels = float(args[0]), int(args[1])
+        args = args[2:]
+    elif command == 'listen':
+        # Optional events=Hangup,Newchannel to only get those events, and
+        # sink=SPEC to write them somewhere else (see monamisink).
+        events, sink = None, None
+        while args and args[0].startswith(('events=', 'sink=')):
+            arg = args.pop(0)
+            if arg.startswith('events='):
+                events = arg[7:].split(',')
+            else:
+                sink = make_sink(arg[5:])
+    elif command == 'reload':
         pass
+    elif command == 'rollingreload':
+        max_parallel, canary = int(args[0]), int(args[1])
+        args = args[2:]
+        # Optional maxfailurerate=RATE (0..1) to stop starting new hosts
+        # once that fraction of them has failed.
+        max_failure_rate = None
+        if args and args[0].startswith('maxfailurerate='):
+            max_failure_rate = float(args.pop(0)[15:])
+    elif command == 'command':
+        cli_command = args.pop(0)
     elif command == 'queuestatus' or command == 'queuesummary':
         queue_id = args.pop(0)
+        # Optional minhosts=N and tail=SECONDS to return when N hosts have
+        # answered (plus SECONDS), instead of waiting for all of them.
+        min_hosts, tail_timeout = None, 0
+        while args and args[0].startswith(('minhosts=', 'tail=')):
+            arg = args.pop(0)
+            if arg.startswith('minhosts='):
+                min_hosts = int(arg[9:])
+            else:
+                tail_timeout = float(arg[5:])
+    elif command == 'daemon':
+        socket_path = args.pop(0)
     else:
         raise ValueError('Use the source, Luke')
 
+    # Talk to a running "monamish daemon" instead of to the asterisken, if
+    # the only host is a unix:/path/to/socket.
+    if (len(args) == 1 and args[0].startswith('unix:') and
+            command in ('command', 'queuestatus', 'queuesummary', 'reload')):
+        query_args = {'command': [cli_command], 'queuestatus': [queue_id],
+                      'queuesummary': [queue_id]}.get(command, [])
+        result, errors = daemon_query(args[0][5:], command, query_args)
+        if command == 'command':
+            for host, output in sorted(result.items()):
+                sys.stdout.write(output)
+        elif command == 'reload':
+            print('Reload successful on %d asterisken.' % (result,))
+        else:
+            print(result)
+        for error in errors:
+            print('%s: %s' % error, file=sys.stderr)
+        if errors:
+            sys.exit(1)
+        return
+
     # Compile a list of host/user/pass arguments
     ami_kwargs = [amiaddr_to_dict(i) for i in args]
 
@@ -222,6 +872,23 @@ def main():
                           'Exten': exten, 'Priority': 1})
         print('Originate probably succeeded.')
 
+    # Set up lots of calls, one JSON dict of Originate params per input line
+    elif command == 'bulkoriginate':
+        assert len(ami_kwargs) == 1, 'Use one asterisk per run'
+
+        def on_result(result):
+            print('%s\t%s\t%s\t%.3f' % (
+                result['spec'].get('Channel'),
+                'OK' if result['success'] else 'FAIL',
+                result['reason'], result['latency']))
+
+        specs = (json.loads(line) for line in sys.stdin if line.strip())
+        summary = BulkOriginate(
+            ami_kwargs[0], calls_per_second=calls_per_second,
+            max_channels=max_channels).run(specs, on_result)
+        print('%(success)d succeeded, %(failure)d failed, average latency '
+              '%(latency).3fs' % summary, file=sys.stderr)
+
     # Reload the config
     elif command == 'reload':
         errors = reload_asterisken(ami_kwargs)
@@ -236,23 +903,67 @@ def main():
                 print('%s: %s' % (error[0]['host'], error[1]), file=sys.stderr)
             sys.exit(1)
 
+    # Reload the config on a few hosts at a time
+    elif command == 'rollingreload':
+        def on_result(result):
+            print('%s: %s in %.3fs (%s)' % (
+                result['ami_kwarg']['host'],
+                result['error'] or 'reloaded', result['duration'],
+                ', '.join('%s %.3fs' % i for i in result['timings'])))
+
+        results, skipped = rolling_reload_asterisken(
+            ami_kwargs, max_parallel=max_parallel, canary=canary,
+            max_failure_rate=max_failure_rate, on_result=on_result)
+        for ami_kwarg in skipped:
+            print('%s: skipped' % (ami_kwarg['host'],), file=sys.stderr)
+        if skipped or any(result['error'] for result in results):
+            sys.exit(1)
+
+    # Run a CLI command, streaming the output
+    elif command == 'command':
+        def on_output(line, input):
+            sys.stdout.write(line)
+
+        output, errors = cli_asterisken(ami_kwargs, cli_command, on_output)
+        for error in errors:
+            print('%s: %s' % (error[0]['host'], error[1]), file=sys.stderr)
+        if errors:
+            sys.exit(1)
+
     # Info about a queue
     elif command == 'queuesummary':
-        print(fetch_queuesummary(ami_kwargs, queue_id))
+        print(fetch_queuesummary(
+            ami_kwargs, queue_id, min_hosts=min_hosts,
+            tail_timeout=tail_timeout))
 
     # Not so useful
     elif command == 'queuestatus':
-        print(fetch_queuestatus(ami_kwargs, queue_id))
+        print(fetch_queuestatus(
+            ami_kwargs, queue_id, min_hosts=min_hosts,
+            tail_timeout=tail_timeout))
+
+    # Keep sessions open and serve queries from local clients
+    elif command == 'daemon':
+        daemon = MonamishDaemon(ami_kwargs)
+        try:
+            daemon.serve(socket_path)
+        finally:
+            daemon.close()
 
     # Listen with one or more AMIs at the same time
     elif command == 'listen':
-        s = MultiHostSequentialAmi()
-        s.add_action('events', {'EventMask': 'on'})
-        for ami_kwarg in ami_kwargs:
-            s.add_connection(auth='md5', keepalive=10,
-                             disconnect_mode=SequentialAmi.DIS_NEVER,
-                             **ami_kwarg)
-        errors = s.process()
+        def on_event(when, host, received, dict):
+            print('Got event: %s from %s at %f\n%s\n' % (
+                dict.get('Event'), host, when, '\n'.join(
+                    '  %s\t%r' % (k, v)
+                    for k, v in dict.items() if k != 'Event')))
+
+        try:
+            errors = listen_asterisken(
+                ami_kwargs, sink.on_event if sink else on_event, events=events)
+        finally:
+            if sink:
+                sink.close()
         print(errors)  # a list of error tuples [(ami_kwarg, error), ...]
 
 
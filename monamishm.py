@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# vim: set ts=8 sw=4 sts=4 et ai tw=79:
+"""
+Publish the queue statistics of a fleet of asterisken in a shared memory
+segment (an mmap()ed file, preferably on /dev/shm), so any number of local
+processes (e.g. web workers) can read them without talking to the
+asterisken themselves.
+
+Usage::
+
+    monamishm publish PATH INTERVAL QUEUE,QUEUE,... HOSTS...
+    monamishm read PATH
+
+The publisher keeps AMI sessions to the hosts open (see MonamishDaemon),
+fetches the queuesummary and queuestatus of every queue every INTERVAL
+seconds and writes them into PATH.
+
+Reading from Python::
+
+    reader = QueueStatsReader('/dev/shm/queuestats')
+    updated, stats = reader.read()
+    print(stats['22']['queued_callers'])
+
+Layout (little endian): a header with magic ``MQS1``, the amount of slots,
+the sequence number and the publication time; followed by that many
+slots of the queue name (64 bytes, NUL padded), its update time and the
+FIELDS as int64s. The sequence number is a seqlock: it's odd while the
+publisher is writing. Readers copy the segment and retry if the sequence
+number was odd or changed meanwhile, so they never see half-written
+stats and never block the publisher.
+"""
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+# Local friend package.
+from monamish import (
+    MonamishDaemon, amiaddr_to_dict, translate_queuestatus,
+    translate_queuesummary)
+
+
+MAGIC = b'MQS1'
+# translate_queuesummary() and translate_queuestatus() keys.
+SUMMARY_FIELDS = (
+    'average_holdtime', 'average_talktime', 'current_holdtime',
+    'queued_callers')
+STATUS_FIELDS = ('abandoned', 'calls', 'completed', 'holdtime', 'talktime')
+FIELDS = SUMMARY_FIELDS + STATUS_FIELDS
+
+HEADER = struct.Struct('<4sIQd')  # magic, slots, sequence, updated
+SEQUENCE = struct.Struct('<Q')
+SEQUENCE_OFFSET = 8
+SLOT = struct.Struct('<64sd%dq' % (len(FIELDS),))  # name, updated, FIELDS
+
+
+def segment_size(slots):
+    return HEADER.size + slots * SLOT.size
+
+
+class QueueStatsWriter(object):
+    """
+    Create (or reuse) the segment at path, with room for slots queues, and
+    publish() stats into it. There should be only one writer per segment.
+    """
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        size = segment_size(slots)
+        try:
+            reuse = os.path.getsize(path) == size
+        except OSError:
+            reuse = False
+
+        if reuse:
+            # Same layout: keep the file, so the readers keep working.
+            fd = os.open(path, os.O_RDWR)
+        else:
+            # Build it next to the old one and rename it into place. The
+            # old one is marked as stale, so its readers reopen the path.
+            fd = os.open(path + '.tmp', os.O_RDWR | os.O_CREAT | os.O_TRUNC,
+                         0o644)
+            os.ftruncate(fd, size)
+        try:
+            self._buf = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        if reuse:
+            self._sequence = SEQUENCE.unpack_from(
+                self._buf, SEQUENCE_OFFSET)[0]
+            self._sequence += self._sequence & 1  # writer died halfway
+        else:
+            self._sequence = 0
+            HEADER.pack_into(self._buf, 0, MAGIC, slots, 0, 0.0)
+            self._mark_stale(path)
+            os.rename(path + '.tmp', path)
+
+    def publish(self, stats, updated=None, now=None):
+        """
+        Write the stats: {queue: {field: value, ...}, ...}. Missing fields
+        are written as 0. If updated ({queue: timestamp}) is passed, those
+        are the update times of the queues, otherwise now is.
+        """
+        if len(stats) > self.slots:
+            raise ValueError('%d queues do not fit in %d slots' % (
+                len(stats), self.slots))
+        if now is None:
+            now = time.time()
+        updated = updated or {}
+        slots = [
+            SLOT.pack(queue.encode('utf-8')[:64], updated.get(queue, now),
+                      *[int(values.get(field, 0)) for field in FIELDS])
+            for queue, values in sorted(stats.items())]
+        data = b''.join(slots) + b'\0' * (
+            (self.slots - len(slots)) * SLOT.size)
+
+        self._set_sequence(self._sequence + 1)  # odd: writing
+        self._buf[HEADER.size:] = data
+        HEADER.pack_into(
+            self._buf, 0, MAGIC, self.slots, self._sequence, now)
+        self._set_sequence(self._sequence + 1)  # even: done
+
+    def close(self):
+        self._buf.close()
+
+    def _set_sequence(self, sequence):
+        self._sequence = sequence
+        SEQUENCE.pack_into(self._buf, SEQUENCE_OFFSET, sequence)
+
+    @staticmethod
+    def _mark_stale(path):
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except OSError:
+            return
+        try:
+            if os.fstat(fd).st_size >= HEADER.size:
+                os.write(fd, b'\0' * len(MAGIC))
+        finally:
+            os.close(fd)
+
+
+class QueueStatsReader(object):
+    """
+    Read the stats a QueueStatsWriter published at path. Reading is
+    lock-free and needs no system calls, unless the publisher recreated
+    the segment with a different layout; then it's reopened.
+    """
+    max_retries = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self._buf = None
+        self._open()
+
+    def read(self):
+        """
+        Return the publication time and the stats: (updated, {queue:
+        {field: value, ..., 'updated': timestamp}, ...}).
+        """
+        for attempt in range(self.max_retries):
+            if attempt > 10:
+                time.sleep(0)  # let the writer finish
+            sequence = SEQUENCE.unpack_from(self._buf, SEQUENCE_OFFSET)[0]
+            if sequence & 1:
+                continue
+            data = self._buf[:]
+            if SEQUENCE.unpack_from(
+                    self._buf, SEQUENCE_OFFSET)[0] != sequence:
+                continue
+            magic, slots, sequence, updated = HEADER.unpack_from(data, 0)
+            if magic == MAGIC:
+                break
+            # Replaced by a segment with a different layout.
+            self._open()
+        else:
+            raise ValueError('segment %r is never consistent' % (self.path,))
+
+        stats = {}
+        for slot in range(slots):
+            values = SLOT.unpack_from(data, HEADER.size + slot * SLOT.size)
+            queue = values[0].rstrip(b'\0').decode('utf-8', 'replace')
+            if queue:
+                stats[queue] = dict(zip(FIELDS, values[2:]))
+                stats[queue]['updated'] = values[1]
+        return updated, stats
+
+    def get(self, queue):
+        """
+        Return the stats of a single queue, or None.
+        """
+        return self.read()[1].get(queue)
+
+    def close(self):
+        self._buf.close()
+
+    def _open(self):
+        if self._buf:
+            self._buf.close()
+        with open(self.path, 'rb') as fp:
+            self._buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class QueueStatsPublisher(object):
+    """
+    Fetch the queuesummary and queuestatus of the queues from all hosts
+    every interval seconds and publish them with a QueueStatsWriter. One
+    QueueSummary and one QueueStatus of all queues is sent to every host,
+    so a stuck host costs a single query timeout per poll. If all hosts
+    fail, the queues keep their previous stats (and update time).
+    """
+    ACTIONS = (
+        ('QueueSummary', {}, 'QueueSummaryComplete'),
+        ('QueueStatus', {}, 'QueueStatusComplete'),
+    )
+    def __init__(self, ami_kwargs, queues, path, interval=5):
+        self.queues = list(queues)
+        self.interval = interval
+        self._hosts = len(ami_kwargs)
+        self._daemon = MonamishDaemon(ami_kwargs)
+        self._writer = QueueStatsWriter(path, len(self.queues))
+        self._stats = dict((queue, {}) for queue in self.queues)
+        self._updated = dict((queue, 0.0) for queue in self.queues)
+        self._closed = threading.Event()
+
+    def poll(self):
+        """
+        Fetch and publish once. Returns a list of (host, error).
+        """
+        results, errors = self._daemon.fetch(self.ACTIONS)
+        if len(errors) < self._hosts:
+            # Split the events per queue: (summary data, status data).
+            data = dict((queue, ([], [])) for queue in self.queues)
+            for host, index, parameters, response, events in results:
+                for event in events:
+                    if event.get('Queue') in data:
+                        data[event['Queue']][index].append(
+                            (event, parameters))
+            now = time.time()
+            for queue, (summary, status) in data.items():
+                values = translate_queuesummary(summary)
+                values.update(translate_queuestatus(status))
+                self._stats[queue] = values
+                self._updated[queue] = now
+        self._writer.publish(self._stats, self._updated)
+        return errors
+
+    def run(self):
+        """
+        Poll until close() is called.
+        """
+        try:
+            while not self._closed.is_set():
+                start = time.time()
+                for host, error in self.poll():
+                    sys.stderr.write('monamishm: %s: %s\n' % (host, error))
+                self._closed.wait(
+                    max(0, start + self.interval - time.time()))
+        finally:
+            self._daemon.close()
+            self._writer.close()
+
+    def close(self):
+        self._closed.set()
+
+
+def main():
+    command, args = ''.join(sys.argv[1:2]), sys.argv[2:]
+    if command == 'publish' and len(args) >= 4:
+        path, interval, queues = args[0], float(args[1]), args[2].split(',')
+        publisher = QueueStatsPublisher(
+            [amiaddr_to_dict(i) for i in args[3:]], queues, path, interval)
+        publisher.run()
+    elif command == 'read' and len(args) == 1:
+        updated, stats = QueueStatsReader(args[0]).read()
+        print('published %.1fs ago' % (time.time() - updated,))
+        for queue, values in sorted(stats.items()):
+            print('%s\t%s' % (queue, ' '.join(
+                '%s=%d' % (field, values[field]) for field in FIELDS)))
+    else:
+        raise ValueError('Use the source, Luke')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# vim: set ts=8 sw=4 sts=4 et ai tw=79:
+"""
+Output sinks for listened-to AMI events. Events are written as JSON lines::
+
+    {"host": "pbx1", "time": 1444125000.1, "received": 1444125000.2,
+     "event": {"Event": "Hangup", ...}}
+
+The sinks buffer the events and flush them every flush_interval seconds
+(from a background thread) or when the buffer gets large. Every
+report_interval seconds the throughput is reported to stderr.
+
+Use make_sink() to create one from a command line spec:
+
+* ``json`` -- JSON lines on stdout;
+* ``file:PATH[,max_bytes=N][,max_seconds=N][,gzip]`` -- JSON lines in
+  PATH.YYYYmmdd-HHMMSS files, starting a new file when it gets max_bytes
+  big or max_seconds old; optionally gzipped;
+* ``unix:PATH`` -- JSON lines in batched datagrams, sent to the UNIX
+  datagram socket PATH.
+
+All of them take an optional ``,flush=SECONDS`` and ``,report=SECONDS``.
+"""
+import gzip
+import json
+import socket
+import sys
+import threading
+import time
+
+
+class Sink(object):
+    """
+    Base class: buffers the encoded events and hands them to _write() in
+    batches. Subclasses implement _write(lines) and optionally _close().
+    """
+    max_buffer = 1024 * 1024  # flush right away when this many bytes wait
+
+    def __init__(self, flush_interval=1.0, report_interval=60):
+        self.flush_interval = flush_interval
+        self.report_interval = report_interval
+        self.events = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._buffer = []
+        self._buffered = 0
+        self._started = self._reported = time.time()
+        self._reported_events = 0
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='Sink')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, host, when, received, dict):
+        line = (json.dumps({
+            'host': host, 'time': when, 'received': received, 'event': dict,
+        }, separators=(',', ':')) + '\n').encode('utf-8')
+        with self._lock:
+            self._buffer.append(line)
+            self._buffered += len(line)
+            self.events += 1
+            full = self._buffered >= self.max_buffer
+        if full:
+            self.flush()
+
+    def on_event(self, when, host, received, dict):
+        """
+        Write an event; the signature matches the listen_asterisken()
+        on_event callback.
+        """
+        self.write(host, when, received, dict)
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                lines, self._buffer, self._buffered = self._buffer, [], 0
+            if lines:
+                self._write(lines)
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self.flush()
+        self.report()
+        self._close()
+
+    def rate(self):
+        """
+        Return the average amount of events per second since we started.
+        """
+        return self.events / max(time.time() - self._started, 0.001)
+
+    def report(self):
+        now = time.time()
+        with self._lock:
+            events = self.events - self._reported_events
+            self._reported_events, elapsed = self.events, now - self._reported
+            self._reported = now
+        sys.stderr.write(
+            'monamisink: %d events (%.1f events/s, %.1f events/s average), '
+            '%d dropped\n' % (
+                events, events / max(elapsed, 0.001), self.rate(),
+                self.dropped))
+
+    def _run(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+            if (self.report_interval and
+                    time.time() - self._reported >= self.report_interval):
+                self.report()
+
+    def _write(self, lines):
+        raise NotImplementedError()
+
+    def _close(self):
+        pass
+
+
+class JsonLinesSink(Sink):
+    """
+    Write the events to a binary stream, stdout by default.
+    """
+    def __init__(self, stream=None, **kwargs):
+        self._stream = stream or sys.stdout.buffer
+        super(JsonLinesSink, self).__init__(**kwargs)
+
+    def _write(self, lines):
+        self._stream.write(b''.join(lines))
+        self._stream.flush()
+
+
+class RotatingFileSink(Sink):
+    """
+    Write the events to PATH.YYYYmmdd-HHMMSS files (with .gz appended if
+    compress is set), starting a new file when the current one has
+    max_bytes (uncompressed) or is max_seconds old.
+    """
+    def __init__(self, path, max_bytes=None, max_seconds=None,
+                 compress=False, **kwargs):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.compress = compress
+        self.filename = None
+        self._basename = None
+        self._sequence = 0
+        self._file = None
+        super(RotatingFileSink, self).__init__(**kwargs)
+
+    def _write(self, lines):
+        if self._file and (
+                (self.max_bytes and self._size >= self.max_bytes) or
+                (self.max_seconds and
+                 time.time() - self._opened >= self.max_seconds)):
+            self._close()
+        if not self._file:
+            self._open()
+        data = b''.join(lines)
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+
+    def _open(self):
+        self._opened = time.time()
+        filename = '%s.%s' % (
+            self.path, time.strftime('%Y%m%d-%H%M%S',
+                                     time.localtime(self._opened)))
+        if filename == self._basename:
+            # Rotating more than once a second.
+            self._sequence += 1
+        else:
+            self._basename, self._sequence = filename, 0
+        if self._sequence:
+            filename = '%s.%d' % (filename, self._sequence)
+        if self.compress:
+            filename += '.gz'
+            self._file = gzip.open(filename, 'ab')
+        else:
+            self._file = open(filename, 'ab')
+        self.filename = filename
+        self._size = 0
+
+    def _close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class DatagramSink(Sink):
+    """
+    Send the events to the UNIX datagram socket path, as many lines per
+    datagram as fit in max_datagram bytes. Datagrams that cannot be sent
+    (no listener, buffers full) are counted as dropped.
+    """
+    def __init__(self, path, max_datagram=65000, **kwargs):
+        self.path = path
+        self.max_datagram = max_datagram
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(0)
+        super(DatagramSink, self).__init__(**kwargs)
+
+    def _write(self, lines):
+        batch, size = [], 0
+        for line in lines + [None]:
+            if batch and (line is None or
+                          size + len(line) > self.max_datagram):
+                try:
+                    self._sock.sendto(b''.join(batch), self.path)
+                except socket.error:
+                    self.dropped += len(batch)
+                batch, size = [], 0
+            if line is not None:
+                batch.append(line)
+                size += len(line)
+
+    def _close(self):
+        self._sock.close()
+
+
+def make_sink(spec):
+    """
+    Create a sink from a spec; see the module docstring.
+    """
+    kind, sep, rest = spec.partition(':')
+    args = rest.split(',') if rest else []
+    if kind == 'json':
+        pass
+    elif kind in ('file', 'unix') and args and args[0]:
+        path, args = args[0], args[1:]
+    else:
+        raise ValueError('invalid sink %r' % (spec,))
+
+    kwargs = {}
+    for arg in args:
+        key, sep, value = arg.partition('=')
+        if key == 'flush':
+            kwargs['flush_interval'] = float(value)
+        elif key == 'report':
+            kwargs['report_interval'] = float(value)
+        elif kind == 'file' and key in ('max_bytes', 'max_seconds'):
+            kwargs[key] = int(value)
+        elif kind == 'file' and key == 'gzip':
+            kwargs['compress'] = True
+        else:
+            raise ValueError('invalid sink option %r' % (arg,))
+
+    if kind == 'json':
+        return JsonLinesSink(**kwargs)
+    elif kind == 'file':
+        return RotatingFileSink(path, **kwargs)
+    return DatagramSink(path, **kwargs)
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# vim: set ts=8 sw=4 sts=4 et ai tw=79:
+"""
+Measure call transfers on a fleet of asterisken, live, from the AMI events.
+See ossokb-sip-transfers.rst for what the transfer types look like on the
+SIP side.
+
+Usage::
+
+    monamitransfer INTERVAL HOSTS...
+
+This listens for the transfer related events on all hosts and prints the
+per-type counts and completion latencies every INTERVAL seconds.
+
+The types and how they're measured (Asterisk 12+ events):
+
+* ``redirect`` -- a DialEnd/DialState with a Forward header (302); done
+  when the caller gets a dial answered, latency from the redirect;
+* ``pickup`` -- a Pickup; done right away, latency from the DialBegin of
+  the picked up channel (the ringing time);
+* ``blind`` -- a BlindTransfer; done when the transferee gets a dial
+  answered, latency from the transfer;
+* ``attended`` -- an AttendedTransfer to an answered target; done right
+  away, latency from the DialBegin of the consultation call;
+* ``blonde`` -- an AttendedTransfer to a target that is still ringing;
+  done when the target answers, latency from the transfer.
+
+Transfers fail when the channel we're waiting for hangs up first, and
+expire when nothing happens for max_age seconds.
+
+Programmatic usage::
+
+    tracker = TransferTracker()
+    listen_asterisken(ami_kwargs, tracker.on_event,
+                      events=TransferTracker.EVENTS)
+    # Meanwhile, from another thread:
+    print(tracker.stats())
+"""
+import sys
+import threading
+import time
+from collections import deque
+
+# Local friend package.
+from monamipoll import RingBuffer
+from monamish import amiaddr_to_dict, listen_asterisken
+
+
+class ExpiringTable(object):
+    """
+    Dictionary whose items are dropped max_age seconds after they were last
+    set. The expiry times are kept in a FIFO, so expire() only looks at the
+    items that are due.
+    """
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self._items = {}        # key => (expires, value)
+        self._expiry = deque()  # (expires, key), oldest first
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        try:
+            return self._items[key][1]
+        except KeyError:
+            return default
+
+    def set(self, key, value, now):
+        expires = now + self.max_age
+        self._items[key] = (expires, value)
+        self._expiry.append((expires, key))
+
+    def pop(self, key, default=None):
+        try:
+            return self._items.pop(key)[1]
+        except KeyError:
+            return default
+
+    def expire(self, now):
+        """
+        Drop the items that are due, and return them as (key, value) tuples.
+        """
+        ret = []
+        while self._expiry and self._expiry[0][0] <= now:
+            expires, key = self._expiry.popleft()
+            item = self._items.get(key)
+            # Skip the FIFO entries of items that were set again or popped.
+            if item and item[0] == expires:
+                del self._items[key]
+                ret.append((key, item[1]))
+        return ret
+
+
+class TransferTracker(object):
+    """
+    Follow the transfer related events of one or more hosts (pass them to
+    on_event(), in time order) and keep per-type counts and completion
+    latencies. See the module docstring.
+
+    Channels are correlated by (host, Uniqueid); transfers that wait for a
+    dial are also found by (host, Linkedid), so dials done through Local
+    channels are seen too.
+
+    If you pass on_transfer, it is called as on_transfer(host, type, result,
+    latency) for every transfer that is done, where result is 'completed',
+    'failed' or 'expired' and latency may be None.
+    """
+    EVENTS = ('AttendedTransfer', 'BlindTransfer', 'DialBegin', 'DialEnd',
+              'DialState', 'Hangup', 'Pickup')
+    TYPES = ('redirect', 'pickup', 'blind', 'attended', 'blonde')
+
+    def __init__(self, max_age=3600, capacity=1024, on_transfer=None):
+        self.on_transfer = on_transfer
+        # (host, dest uniqueid) => {'begin': when, 'answered': when}
+        self._dials = ExpiringTable(max_age)
+        # (host, uniqueid) and (host, linkedid) => transfer dict
+        self._pending = ExpiringTable(max_age)
+        self._counts = dict(
+            (type_, {'started': 0, 'completed': 0, 'failed': 0,
+                     'expired': 0, 'pending': 0})
+            for type_ in self.TYPES)
+        self._latencies = dict(
+            (type_, RingBuffer(capacity)) for type_ in self.TYPES)
+        self._lock = threading.Lock()
+
+    def on_event(self, when, host, received, dict):
+        """
+        Feed an event; the signature matches the listen_asterisken()
+        on_event callback.
+        """
+        with self._lock:
+            for key, transfer in self._pending.expire(when):
+                if transfer['keys'][0] == key:  # once per transfer
+                    self._finish(transfer, 'expired', when)
+            self._dials.expire(when)
+
+            handler = getattr(self, '_on_%s' % (dict.get('Event'),), None)
+            if handler:
+                handler(when, host, dict)
+
+    def stats(self, seconds=None):
+        """
+        Return {type: {'started': N, 'completed': N, 'failed': N, 'expired':
+        N, 'pending': N, 'latency_p50': S, 'latency_p95': S}} for all types.
+        The latencies are those of the last seconds, if set, and None if
+        there are none.
+        """
+        with self._lock:
+            ret = {}
+            for type_ in self.TYPES:
+                latencies = self._latencies[type_]
+                ret[type_] = dict(self._counts[type_])
+                ret[type_]['latency_p50'] = latencies.percentile(50, seconds)
+                ret[type_]['latency_p95'] = latencies.percentile(95, seconds)
+            return ret
+
+    # Event handlers
+    def _on_DialBegin(self, when, host, dict):
+        self._dials.set((host, dict.get('DestUniqueid')), {
+            'begin': when, 'answered': None}, when)
+
+    def _on_DialState(self, when, host, dict):
+        if dict.get('Forward'):
+            self._start(
+                'redirect', host, when, dict.get('Uniqueid'),
+                dict.get('Linkedid'), 'caller')
+
+    def _on_DialEnd(self, when, host, dict):
+        if dict.get('Forward'):
+            self._on_DialState(when, host, dict)
+            return
+        if dict.get('DialStatus') != 'ANSWER':
+            # Other destinations may still be tried. Hangup or expiry ends
+            # the transfers that wait for this one.
+            return
+        dest = dict.get('DestUniqueid')
+        dial = self._dials.get((host, dest))
+        if dial:
+            dial['answered'] = when
+        transfer = self._pending.get((host, dest))
+        if transfer and transfer['wait'] == 'dest':
+            self._finish(transfer, 'completed', when)
+        for key in ((host, dict.get('Uniqueid')),
+                    (host, dict.get('Linkedid'))):
+            transfer = self._pending.get(key)
+            if transfer and transfer['wait'] == 'caller':
+                self._finish(transfer, 'completed', when)
+                break
+
+    def _on_BlindTransfer(self, when, host, dict):
+        if dict.get('Result') != 'Success':
+            self._count('blind', 'started')
+            self._count('blind', 'failed')
+            return
+        self._start(
+            'blind', host, when, dict.get('TransfereeUniqueid'),
+            dict.get('TransfereeLinkedid'), 'caller')
+
+    def _on_AttendedTransfer(self, when, host, dict):
+        target = dict.get('TransferTargetUniqueid')
+        dial = self._dials.get((host, target))
+        if dict.get('Result') != 'Success':
+            self._count('attended', 'started')
+            self._count('attended', 'failed')
+        elif dial and dial['answered'] is None:
+            # Still ringing.
+            self._start('blonde', host, when, target, None, 'dest')
+        else:
+            self._count('attended', 'started')
+            self._done(host, 'attended', 'completed', (
+                when - dial['begin'] if dial else None), when)
+
+    def _on_Pickup(self, when, host, dict):
+        dial = self._dials.get((host, dict.get('TargetUniqueid')))
+        self._count('pickup', 'started')
+        self._done(host, 'pickup', 'completed', (
+            when - dial['begin'] if dial else None), when)
+
+    def _on_Hangup(self, when, host, dict):
+        uniqueid = dict.get('Uniqueid')
+        self._dials.pop((host, uniqueid))
+        transfer = self._pending.get((host, uniqueid))
+        if transfer:
+            self._finish(transfer, 'failed', when)
+
+    # Bookkeeping
+    def _count(self, type_, what, delta=1):
+        self._counts[type_][what] += delta
+
+    def _start(self, type_, host, when, uniqueid, linkedid, wait):
+        keys = [(host, uniqueid)]
+        if linkedid and linkedid != uniqueid:
+            keys.append((host, linkedid))
+        transfer = {'type': type_, 'host': host, 'start': when,
+                    'wait': wait, 'keys': keys}
+        # A newer transfer of the same channel replaces the older one.
+        old = self._pending.get(keys[0])
+        if old:
+            self._finish(old, 'failed', when)
+        for key in keys:
+            self._pending.set(key, transfer, when)
+        self._count(type_, 'started')
+        self._count(type_, 'pending')
+
+    def _finish(self, transfer, result, when):
+        for key in transfer['keys']:
+            if self._pending.get(key) is transfer:
+                self._pending.pop(key)
+        self._count(transfer['type'], 'pending', -1)
+        latency = when - transfer['start'] if result == 'completed' else None
+        self._done(transfer['host'], transfer['type'], result, latency, when)
+
+    def _done(self, host, type_, result, latency, when):
+        self._count(type_, result)
+        if latency is not None:
+            self._latencies[type_].append(when, latency)
+        if self.on_transfer:
+            self.on_transfer(host, type_, result, latency)
+
+
+def main():
+    interval, hosts = float(sys.argv[1]), sys.argv[2:]
+    if not hosts:
+        raise ValueError('Use the source, Luke')
+    tracker = TransferTracker()
+
+    def report():
+        while True:
+            time.sleep(interval)
+            for type_, stats in sorted(tracker.stats(3600).items()):
+                latencies = [
+                    '-' if stats[i] is None else '%.1fs' % (stats[i],)
+                    for i in ('latency_p50', 'latency_p95')]
+                print('%s\t%d started\t%d completed\t%d failed\t'
+                      '%d expired\t%d pending\tp50 %s\tp95 %s' % ((
+                          type_, stats['started'], stats['completed'],
+                          stats['failed'], stats['expired'],
+                          stats['pending']) + tuple(latencies)))
+            print()
+
+    thread = threading.Thread(target=report)
+    thread.daemon = True
+    thread.start()
+    errors = listen_asterisken(
+        [amiaddr_to_dict(i) for i in hosts], tracker.on_event,
+        events=TransferTracker.EVENTS)
+    print(errors)  # a list of error tuples [(ami_kwarg, error), ...]
+
+
+if __name__ == '__main__':
+    main()
@@ -3,10 +3,16 @@ from setuptools import setup
 setup(
     name='voiputil',
     version='0.2.0',
-    py_modules=['monami', 'monamish'],
+    py_modules=['monami', 'monamipoll', 'monamiproxy', 'monamish',
+                'monamishm', 'monamisink', 'monamitransfer', 'siptrace'],
     entry_points='''
         [console_scripts]
         monami=monami:main
+        monamipoll=monamipoll:main
+        monamiproxy=monamiproxy:main
         monamish=monamish:main
+        monamishm=monamishm:main
+        monamitransfer=monamitransfer:main
+        siptrace=siptrace:main
     ''',
 )
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# vim: set ts=8 sw=4 sts=4 et ai tw=79:
+"""
+Find and classify the call transfers in (large) SIP traces: Asterisk "sip
+set debug" output, HEP/sngrep text dumps, or anything else that has the
+SIP messages in them verbatim.
+
+Usage::
+
+    siptrace FILE...
+
+This prints one line per transfer (file offset, type, Call-ID, target,
+status) and the count per type at the end. The types are those of
+ossokb-sip-transfers.rst:
+
+* ``302`` -- a 302 response to an INVITE; the target is the Contact;
+* ``pickup`` -- an INVITE with Replaces of an early dialog;
+* ``blind`` -- a REFER without Replaces in the Refer-To;
+* ``attended`` -- a REFER with Replaces of a confirmed dialog (or an
+  INVITE with Replaces of a confirmed dialog that we saw no REFER for);
+* ``blonde`` -- a REFER with Replaces of a dialog that's still early.
+
+The files are mmap()ed and scanned for SIP start lines with a regex. Only
+the headers we need are parsed and message bodies are skipped using the
+Content-Length, so files larger than RAM are read at about disk speed.
+Only the dialog state is kept in memory: dialogs are indexed by Call-ID,
+From-tag and To-tag, and dropped when they're hung up.
+"""
+import mmap
+import re
+import sys
+from collections import OrderedDict
+try:
+    from urllib.parse import unquote
+except ImportError:
+    from urllib import unquote
+
+
+# Start line of a request or a response.
+START_LINE_RE = re.compile(
+    br'^(?:([A-Z]+) [^ \r\n]+ SIP/2\.0|SIP/2\.0 ([1-6][0-9][0-9])[^\r\n]*)'
+    br'\r?$', re.M)
+# End of the headers: an empty line, or the end marker of "sip set debug".
+HEADERS_END_RE = re.compile(br'\n\r?\n|\n<-{3}')
+# The headers we're interested in, including their compact forms.
+HEADER_RE = re.compile(
+    br'^(call-id|i|from|f|to|t|cseq|contact|m|refer-to|r|replaces|'
+    br'content-length|l|content-type|c|event|o)[ \t]*:[ \t]*([^\r\n]*)',
+    re.M | re.I)
+COMPACT_HEADERS = {
+    'i': 'call-id', 'f': 'from', 't': 'to', 'm': 'contact', 'r': 'refer-to',
+    'l': 'content-length', 'c': 'content-type', 'o': 'event'}
+TAG_RE = re.compile(r';\s*tag=([^;>\s]+)', re.I)
+max_headers = 65536  # don't look further than this for the end of headers
+max_body = 65536     # don't skip more than this for a Content-Length
+
+
+def iter_messages(buf, pos=0):
+    """
+    Yield the SIP messages in buf (bytes or an mmap), starting at offset
+    pos, as dicts: {'offset': N, 'method': 'INVITE' or None, 'status':
+    200 or None, 'headers': {'call-id': '...', ...}, 'body': b'...'}.
+
+    Only the headers we need are parsed (see HEADER_RE); header names
+    are lowercase and compact forms are expanded. The body is only
+    returned for message/sipfrag content, for the rest it's b''.
+    """
+    size = len(buf)
+    while True:
+        match = START_LINE_RE.search(buf, pos)
+        if not match:
+            return
+        pos = match.end()
+        end = HEADERS_END_RE.search(buf, pos, min(size, pos + max_headers))
+        headers_end = end.start() if end else min(size, pos + max_headers)
+        headers = {}
+        for name, value in HEADER_RE.findall(buf[pos:headers_end]):
+            name = name.decode('ascii').lower()
+            name = COMPACT_HEADERS.get(name, name)
+            headers.setdefault(
+                name, value.strip().decode('utf-8', 'replace'))
+
+        body = b''
+        if end and end.group().endswith(b'\n'):  # empty line, body follows
+            try:
+                length = min(int(headers.get('content-length', 0)), max_body)
+            except ValueError:
+                length = 0
+            body_start = end.end()
+            if 'sipfrag' in headers.get('content-type', ''):
+                body = buf[body_start:body_start + length]
+            pos = body_start + length
+        elif end:
+            pos = end.start() + 1
+
+        method, status = match.groups()
+        yield {
+            'offset': match.start(),
+            'method': method.decode('ascii') if method else None,
+            'status': int(status) if status else None,
+            'headers': headers,
+            'body': body,
+        }
+
+
+def parse_replaces(value):
+    """
+    Parse a Replaces value "callid;to-tag=X;from-tag=Y[;early-only]" into
+    (callid, to_tag, from_tag, early_only).
+    """
+    parts = [i.strip() for i in value.split(';')]
+    params = dict(i.partition('=')[::2] for i in parts[1:])
+    return (parts[0], params.get('to-tag'), params.get('from-tag'),
+            'early-only' in params)
+
+
+def refer_to_replaces(value):
+    """
+    Return the (unescaped) Replaces value of a Refer-To header, or None.
+    """
+    match = re.search(r'[?&]Replaces=([^&>]*)', value, re.I)
+    return unquote(match.group(1)) if match else None
+
+
+class TransferClassifier(object):
+    """
+    Follow the dialogs in a stream of SIP messages (see iter_messages()) and
+    classify the transfers in them, by the type table in
+    ossokb-sip-transfers.rst. See the module docstring.
+
+    Each transfer is passed to on_transfer(transfer) as a dict: {'type':
+    '302', 'offset': N, 'call_id': ..., 'target': ..., 'replaces': call-id
+    or None, 'status': ...}. The status is updated by the REFER response
+    and the NOTIFY sipfrags; for attended transfers, 'completed_by' is set
+    to the Call-ID of the INVITE with Replaces, if we see it. So REFER
+    transfers are only passed on when their dialog ends, when the next
+    REFER in the dialog comes in, or when you call flush() at the end of
+    the trace. The others are passed on right away.
+    """
+    TYPES = ('302', 'pickup', 'blind', 'attended', 'blonde')
+    max_ended = 4096  # ended dialogs to remember, against retransmissions
+
+    def __init__(self, on_transfer=None):
+        self.on_transfer = on_transfer
+        self.counts = dict((type_, 0) for type_ in self.TYPES)
+        # call-id => {'from_tag': tag, 'dialogs': {to-tag: state}}, state
+        # being 'early' or 'confirmed'.
+        self._calls = {}
+        self._refers = {}   # call-id of the REFER dialog => transfer
+        self._replaced = {}  # call-id of the replaced dialog => transfer
+        self._seen = {}     # call-id => set of (type, cseq) of its transfers
+        self._ended = OrderedDict()  # the same, of the last ended dialogs
+
+    def feed(self, message):
+        headers = message['headers']
+        call_id = headers.get('call-id')
+        cseq = headers.get('cseq', '')
+        if not call_id:
+            return  # not a SIP message after all (e.g. a sipfrag)
+        cseq_method = cseq.rpartition(' ')[2]
+
+        if message['method']:
+            self._on_request(message, call_id, cseq, headers)
+        elif cseq_method == 'INVITE':
+            self._on_invite_response(message, call_id, cseq, headers)
+        elif cseq_method == 'REFER' and message['status'] >= 200:
+            transfer = self._refers.get(call_id)
+            if transfer:
+                transfer['status'] = message['status']
+        elif (cseq_method == 'BYE' and
+                200 <= message['status'] < 300):
+            self._drop(call_id)
+
+    def flush(self):
+        """
+        Pass on the REFER transfers whose dialogs haven't ended (yet).
+        """
+        for call_id in sorted(
+                self._refers, key=lambda i: self._refers[i]['offset']):
+            self._report(self._refers[call_id])
+        self._refers.clear()
+
+    def dialog_state(self, call_id, tag1, tag2):
+        """
+        Return the state of the dialog with the Call-ID and tags (in either
+        order): 'early', 'confirmed' or None if we don't know it.
+        """
+        call = self._calls.get(call_id)
+        if not call:
+            return None
+        to_tag = tag2 if tag1 == call['from_tag'] else tag1
+        return call['dialogs'].get(to_tag)
+
+    def _on_request(self, message, call_id, cseq, headers):
+        method = message['method']
+        if method == 'INVITE':
+            if call_id not in self._calls:
+                from_tag = TAG_RE.search(headers.get('from', ''))
+                self._calls[call_id] = {
+                    'from_tag': from_tag and from_tag.group(1),
+                    'dialogs': {}}
+            if 'replaces' in headers:
+                self._on_invite_replaces(message, call_id, cseq, headers)
+        elif method == 'REFER':
+            target = headers.get('refer-to', '')
+            replaces = refer_to_replaces(target)
+            if not replaces:
+                self._add('blind', message, call_id, cseq, target)
+                return
+            replaced_id, to_tag, from_tag, early_only = (
+                parse_replaces(replaces))
+            state = self.dialog_state(replaced_id, to_tag, from_tag)
+            transfer = self._add(
+                'blonde' if state == 'early' else 'attended', message,
+                call_id, cseq, target, replaced_id)
+            if transfer:
+                self._replaced[replaced_id] = transfer
+        elif (method == 'NOTIFY' and
+                headers.get('event', '').startswith('refer')):
+            transfer = self._refers.get(call_id)
+            match = re.match(br'SIP/2\.0 ([1-6][0-9][0-9])', message['body'])
+            if transfer and match:
+                transfer['status'] = int(match.group(1))
+        elif method == 'BYE':
+            self._report(self._refers.pop(call_id, None))
+
+    def _on_invite_replaces(self, message, call_id, cseq, headers):
+        replaced_id, to_tag, from_tag, early_only = parse_replaces(
+            headers['replaces'])
+        transfer = self._replaced.pop(replaced_id, None)
+        if transfer:
+            # The final step of an attended transfer.
+            transfer['completed_by'] = call_id
+            return
+        state = self.dialog_state(replaced_id, to_tag, from_tag)
+        if early_only or state != 'confirmed':
+            self._add('pickup', message, call_id, cseq, None, replaced_id)
+        else:
+            self._add('attended', message, call_id, cseq, None, replaced_id)
+
+    def _on_invite_response(self, message, call_id, cseq, headers):
+        status = message['status']
+        call = self._calls.get(call_id)
+        to_tag = TAG_RE.search(headers.get('to', ''))
+        if call and to_tag and 100 < status < 300:
+            dialogs = call['dialogs']
+            if status >= 200:
+                dialogs[to_tag.group(1)] = 'confirmed'
+            else:
+                dialogs.setdefault(to_tag.group(1), 'early')
+        elif status >= 300:
+            if call and to_tag and (
+                    call['dialogs'].get(to_tag.group(1)) == 'confirmed'):
+                # A failed re-INVITE (e.g. a 491 on a hold); the dialog
+                # lives on.
+                return
+            if status == 302:
+                self._add('302', message, call_id, cseq,
+                          headers.get('contact'))
+            # Failed or redirected call; CANCELed ones end up here too.
+            self._drop(call_id)
+
+    def _add(self, type_, message, call_id, cseq, target, replaces=None):
+        # Retransmissions, and messages seen in both directions (on a
+        # B2BUA), are only counted once.
+        key = (type_, cseq)
+        seen = self._ended.get(call_id)
+        if seen is None:
+            seen = self._seen.setdefault(call_id, set())
+        if key in seen:
+            return None
+        seen.add(key)
+        transfer = {
+            'type': type_, 'offset': message['offset'], 'call_id': call_id,
+            'target': target, 'replaces': replaces, 'status': None}
+        self.counts[type_] += 1
+        if message['method'] == 'REFER':
+            # The previous REFER of the dialog gets no more updates.
+            self._report(self._refers.get(call_id))
+            self._refers[call_id] = transfer
+        else:
+            self._report(transfer)
+        return transfer
+
+    def _report(self, transfer):
+        if transfer and self.on_transfer:
+            self.on_transfer(transfer)
+
+    def _drop(self, call_id):
+        self._calls.pop(call_id, None)
+        self._replaced.pop(call_id, None)
+        self._report(self._refers.pop(call_id, None))
+        seen = self._seen.pop(call_id, None)
+        if seen is not None:
+            self._ended[call_id] = seen
+            if len(self._ended) > self.max_ended:
+                self._ended.popitem(last=False)
+
+
+def classify_file(filename, classifier=None):
+    """
+    Feed the SIP messages of the file to the classifier (a new one if None)
+    and return it. Call flush() on it when this was the last file.
+    """
+    if classifier is None:
+        classifier = TransferClassifier()
+    with open(filename, 'rb') as fp:
+        try:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return classifier  # empty file
+        try:
+            if hasattr(buf, 'madvise'):
+                buf.madvise(mmap.MADV_SEQUENTIAL)
+            for message in iter_messages(buf):
+                classifier.feed(message)
+        finally:
+            buf.close()
+    return classifier
+
+
+def main():
+    filenames = sys.argv[1:]
+    if not filenames:
+        raise ValueError('Use the source, Luke')
+    for filename in filenames:
+        def on_transfer(transfer, filename=filename):
+            print('%s:%d\t%s\t%s\t%s\t%s' % (
+                filename, transfer['offset'], transfer['type'],
+                transfer['call_id'], transfer['target'] or (
+                    'replaces %s' % (transfer['replaces'],)),
+                transfer['status'] or '-'))
+
+        classifier = classify_file(filename, TransferClassifier(on_transfer))
+        classifier.flush()
+        print('%s: %s' % (filename, ', '.join(
+            '%s=%d' % (type_, classifier.counts[type_])
+            for type_ in classifier.TYPES)))
+
+
+if __name__ == '__main__':
+    main()
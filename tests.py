@@ -1,8 +1,192 @@
 # vim: set ts=8 sw=4 sts=4 et ai tw=79:
+import gzip
+import io
+import json
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
 import unittest
 
+from monami import (
+    BackgroundAmi, CallbackExecutor, EventMerger, MonAmiActionFailed,
+    MonAmiError, MonAmiTimeout, MultiHostSequentialAmi, RttEstimator,
+    SequentialAmi, events_to_mask, rtt_estimator)
+from monamipoll import FleetPoller, RingBuffer
+from monamiproxy import AmiProxy
 from monamish import (
-    amiaddr_to_dict, translate_queuestatus, translate_queuesummary)
+    BulkOriginate, MonamishDaemon, amiaddr_to_dict, cli_asterisken,
+    daemon_query, fetch_queuesummary, listen_asterisken,
+    rolling_reload_asterisken, translate_queuestatus, translate_queuesummary)
+from monamishm import (
+    QueueStatsPublisher, QueueStatsReader, QueueStatsWriter)
+from monamisink import (
+    DatagramSink, JsonLinesSink, RotatingFileSink, make_sink)
+from monamitransfer import ExpiringTable, TransferTracker
+from siptrace import TransferClassifier, classify_file, iter_messages
+
+
+class FakeAmiServer(object):
+    """
+    Minimal AMI speaking server on localhost, for testing the clients.
+    """
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.received = []
+        self.conns = []
+        self.output_headers = False  # Asterisk 14+ style Command output
+        self.delay = 0  # seconds to wait before responding
+        self.ignore = ()  # actions to not respond to
+        self.refuse = ()  # actions to respond to with an error
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def kwargs(self, **kwargs):
+        kwargs.update({'host': '127.0.0.1', 'port': self.port})
+        return kwargs
+
+    def close(self):
+        self.sock.close()
+
+    def serve(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                break
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def disconnect(self):
+        for conn in self.conns:
+            conn.shutdown(socket.SHUT_RDWR)
+
+    def send_event(self, message):
+        for conn in self.conns:
+            conn.sendall(message)
+
+    def handle(self, conn):
+        self.conns.append(conn)
+        conn.sendall(b'Asterisk Call Manager/1.3\r\n')
+        buf = b''
+        while True:
+            try:
+                data = conn.recv(4096)
+            except OSError:
+                break
+            if not data:
+                break
+            buf += data
+            while b'\r\n\r\n' in buf:
+                msg, buf = buf.split(b'\r\n\r\n', 1)
+                action = dict(
+                    line.decode('utf-8').split(': ', 1)
+                    for line in msg.split(b'\r\n'))
+                self.received.append(action)
+                if action['Action'] in self.ignore:
+                    continue
+                if self.delay and action['Action'] != 'login':
+                    time.sleep(self.delay)
+                try:
+                    conn.sendall(self.respond(action))
+                except OSError:
+                    return
+        conn.close()
+
+    @staticmethod
+    def queues(action):
+        return [action['Queue']] if action.get('Queue') else ['22', '23']
+
+    def respond(self, action):
+        name = action['Action'].lower()
+        aid = action['ActionID']
+        if name == 'command':
+            lines = ['%s output %d' % (action['Command'], i) for i in range(3)]
+            if self.output_headers:
+                return (
+                    'Response: Success\r\nActionID: %s\r\n'
+                    'Message: Command output follows\r\n%s\r\n\r\n' % (
+                        aid, '\r\n'.join('Output: ' + i for i in lines))
+                ).encode('utf-8')
+            return (
+                'Response: Follows\r\nPrivilege: Command\r\n'
+                'ActionID: %s\r\n%s\n--END COMMAND--\r\n\r\n' % (
+                    aid, '\n'.join(lines))).encode('utf-8')
+        elif name == 'queuesummary':
+            return (
+                'Response: Success\r\nActionID: %s\r\nEventList: start\r\n'
+                'Message: Queue summary will follow\r\n\r\n%s'
+                'Event: QueueSummaryComplete\r\nActionID: %s\r\n\r\n' % (
+                    aid, ''.join(
+                        'Event: QueueSummary\r\nQueue: %s\r\nCallers: 2\r\n'
+                        'ActionID: %s\r\n\r\n' % (queue, aid)
+                        for queue in self.queues(action)),
+                    aid)).encode('utf-8')
+        elif name == 'queuestatus':
+            return (
+                'Response: Success\r\nActionID: %s\r\nEventList: start\r\n'
+                '\r\n%s'
+                'Event: QueueStatusComplete\r\nActionID: %s\r\n\r\n' % (
+                    aid, ''.join(
+                        'Event: QueueParams\r\nQueue: %s\r\nCalls: 2\r\n'
+                        'Holdtime: 10\r\nCompleted: 5\r\n'
+                        'ActionID: %s\r\n\r\n' % (queue, aid)
+                        for queue in self.queues(action)),
+                    aid)).encode('utf-8')
+        elif name == 'originate':
+            uniqueid = '%s.1' % (aid,)
+            if action['Channel'] == 'SIP/refused':
+                return ('Response: Error\r\nActionID: %s\r\n'
+                        'Message: Invalid channel\r\n\r\n' % (
+                            aid,)).encode('utf-8')
+            elif action['Channel'] == 'SIP/busy':
+                result = 'Failure\r\nReason: 5'
+            else:
+                result = 'Success\r\nReason: 4'
+            hangup = 'Event: Hangup\r\nUniqueid: %s\r\n\r\n' % (uniqueid,)
+            if action['Channel'] == 'SIP/stuck':
+                hangup = ''  # lost event
+            return (
+                'Response: Success\r\nActionID: %s\r\n'
+                'Message: Originate successfully queued\r\n\r\n'
+                'Event: OriginateResponse\r\nActionID: %s\r\n'
+                'Response: %s\r\nUniqueid: %s\r\n\r\n%s' % (
+                    aid, aid, result, uniqueid, hangup)).encode('utf-8')
+        elif name == 'coreshowchannels':
+            return (
+                'Response: Success\r\nActionID: %s\r\nEventList: start\r\n'
+                '\r\n%s'
+                'Event: CoreShowChannelsComplete\r\nActionID: %s\r\n'
+                '\r\n' % (aid, ''.join(
+                    'Event: CoreShowChannel\r\nActionID: %s\r\n'
+                    'Channel: SIP/%d\r\n\r\n' % (aid, i) for i in range(3)),
+                    aid)).encode('utf-8')
+        elif name == 'sippeers':
+            return (
+                'Response: Success\r\nActionID: %s\r\nEventList: start\r\n'
+                '\r\n%s'
+                'Event: PeerlistComplete\r\nActionID: %s\r\n'
+                '\r\n' % (aid, ''.join(
+                    'Event: PeerEntry\r\nActionID: %s\r\n'
+                    'Status: %s\r\n\r\n' % (aid, status) for status in (
+                        'OK (10 ms)', 'OK (20 ms)', 'UNREACHABLE')),
+                    aid)).encode('utf-8')
+        elif name == 'challenge':
+            return ('Response: Success\r\nChallenge: 123456789\r\n'
+                    'ActionID: %s\r\n\r\n' % (aid,)).encode('utf-8')
+        elif name == 'fail' or action['Action'] in self.refuse:
+            return ('Response: Error\r\nActionID: %s\r\n\r\n' % (
+                aid,)).encode('utf-8')
+        return ('Response: Success\r\nActionID: %s\r\n\r\n' % (
+            aid,)).encode('utf-8')
 
 
 class TestCase(unittest.TestCase):
@@ -118,3 +302,1192 @@ class TestCase(unittest.TestCase):
         expected = {'average_holdtime': 33, 'average_talktime': 16,
                     'current_holdtime': 55, 'queued_callers': 2}
         self.assertEqual(output, expected)
+
+
+class BackgroundAmiTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeAmiServer()
+        self.ami = BackgroundAmi()
+        self.ami.add_connection(name='pbx', **self.server.kwargs())
+        self.ami.start()
+
+    def tearDown(self):
+        self.ami.close()
+        self.server.close()
+
+    def test_futures(self):
+        futures = [
+            self.ami.add_action(
+                'pbx', 'QueueSummary', {'Queue': str(i)},
+                stop_event='QueueSummaryComplete')
+            for i in range(5)]
+        for i, future in enumerate(futures):
+            response, events = future.result(timeout=5)
+            self.assertEqual(response['Response'], 'Success')
+            self.assertEqual(
+                [(e['Event'], e.get('Queue')) for e in events],
+                [('QueueSummary', str(i)), ('QueueSummaryComplete', None)])
+
+    def test_threads(self):
+        results = []
+
+        def worker(i):
+            future = self.ami.add_action(
+                'pbx', 'QueueSummary', {'Queue': str(i)},
+                stop_event='QueueSummaryComplete')
+            results.append(future.result(timeout=5)[1][0]['Queue'])
+
+        threads = [threading.Thread(target=worker, args=(i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), [str(i) for i in range(8)])
+
+    def test_forget_actions(self):
+        for i in range(200):
+            self.ami.add_action(
+                'pbx', 'QueueSummary', {}, 'QueueSummaryComplete').result(5)
+        self.assertRaises(MonAmiActionFailed, self.ami.add_action(
+            'pbx', 'Fail', {}).result, timeout=5)
+        self.ami.add_action('pbx', 'Ping', {}).result(5)
+        self.assertEqual(len(self.ami._amis['pbx']._actions), 0)
+
+    def test_failure(self):
+        futures = [self.ami.add_action('pbx', action, {})
+                   for action in ('Ping', 'Fail', 'Ping')]
+        self.assertEqual(
+            futures[0].result(timeout=5)[0]['Response'], 'Success')
+        self.assertRaises(MonAmiActionFailed, futures[1].result, timeout=5)
+        self.assertEqual(
+            futures[2].result(timeout=5)[0]['Response'], 'Success')
+        # Only the action failed, the connection stays up.
+        self.assertEqual(self.ami.errors(), [])
+        self.assertEqual(self.ami.connections(), set(['pbx']))
+
+
+class CommandOutputTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeAmiServer()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_follows(self):
+        output, errors = cli_asterisken([self.server.kwargs()], 'cmd')
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            output, ['cmd output 0\ncmd output 1\ncmd output 2\n'])
+
+    def test_output_headers(self):
+        self.server.output_headers = True
+        output, errors = cli_asterisken([self.server.kwargs()], 'cmd')
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            output, ['cmd output 0\ncmd output 1\ncmd output 2\n'])
+
+    def test_streaming(self):
+        for output_headers in (False, True):
+            self.server.output_headers = output_headers
+            lines = []
+            output, errors = cli_asterisken(
+                [self.server.kwargs()] * 2, 'cmd',
+                on_output=lambda line, input: lines.append(line))
+            self.assertEqual((output, errors), ([], []))
+            self.assertEqual(
+                sorted(lines),
+                sorted(['cmd output %d\n' % (i,) for i in range(3)] * 2))
+
+
+class MonamishDaemonTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeAmiServer()
+        self.daemon = MonamishDaemon([
+            amiaddr_to_dict('user:pass@127.0.0.1:%d' % (self.server.port,))])
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'monamish.sock')
+        thread = threading.Thread(target=self.daemon.serve, args=(self.path,))
+        thread.daemon = True
+        thread.start()
+        while not os.path.exists(self.path):
+            thread.join(0.01)
+
+    def tearDown(self):
+        self.daemon.close()
+        self.server.close()
+        os.unlink(self.path)
+        os.rmdir(self.tmpdir)
+
+    def test_queries(self):
+        result, errors = daemon_query(self.path, 'queuesummary', ['22'])
+        self.assertEqual(errors, [])
+        self.assertEqual(result['queued_callers'], 2)
+        result, errors = daemon_query(self.path, 'command', ['cmd'])
+        self.assertEqual(
+            result, {'127.0.0.1:%d' % (self.server.port,):
+                     'cmd output 0\ncmd output 1\ncmd output 2\n'})
+        self.assertRaises(ValueError, daemon_query, self.path, 'bad', [])
+        # One md5 login, one session.
+        self.assertEqual(
+            [i['Action'] for i in self.server.received],
+            ['challenge', 'login', 'QueueSummary', 'Command'])
+
+    def test_stale_socket(self):
+        # A live socket is left alone.
+        self.assertRaises(OSError, self.daemon.serve, self.path)
+        # A stale one (from a killed daemon) is replaced.
+        path = os.path.join(self.tmpdir, 'stale.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.close()
+        thread = threading.Thread(target=self.daemon.serve, args=(path,))
+        thread.daemon = True
+        thread.start()
+        try:
+            deadline = time.time() + 5
+            while True:
+                try:
+                    result, errors = daemon_query(path, 'queuesummary', ['22'])
+                    break
+                except socket.error:
+                    if time.time() > deadline:
+                        raise
+                    thread.join(0.01)
+        finally:
+            os.unlink(path)
+        self.assertEqual(result['queued_callers'], 2)
+
+    def test_coalesce(self):
+        daemon_query(self.path, 'queuesummary', ['1'])  # log in first
+        self.server.delay = 0.2
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(
+                self.daemon.query('queuesummary', ['22'])))
+            for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 10)
+        self.assertEqual(
+            [i['Action'] for i in self.server.received].count('QueueSummary'),
+            2)
+
+
+class AmiProxyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeAmiServer()
+        self.proxy = AmiProxy(
+            upstream=self.server.kwargs(), listen=('127.0.0.1', 0),
+            users={'wall': 'board'})
+        self.thread = threading.Thread(target=self.proxy.serve_forever)
+        self.thread.start()
+        while not (self.proxy._upstream and
+                   self.proxy._upstream.is_authenticated()):
+            self.thread.join(0.01)
+
+    def tearDown(self):
+        self.proxy.close()
+        self.thread.join()
+        self.server.close()
+
+    def connect(self, *actions):
+        sock = socket.create_connection(self.proxy.address(), timeout=5)
+        fp = sock.makefile('rb')
+        self.assertEqual(fp.readline(), b'Asterisk Call Manager/1.3\r\n')
+        sock.sendall(
+            b'Action: Login\r\nUsername: wall\r\nSecret: board\r\n\r\n')
+        self.assertEqual(self.read(fp)['Response'], 'Success')
+        for action in actions:
+            sock.sendall(action)
+            self.assertEqual(self.read(fp)['Response'], 'Success')
+        return sock, fp
+
+    def read(self, fp):
+        dict = {}
+        for line in iter(fp.readline, b'\r\n'):
+            key, value = line.decode('utf-8').split(':', 1)
+            dict[key] = value.strip()
+        return dict
+
+    def test_action_routing(self):
+        sock1, fp1 = self.connect()
+        sock2, fp2 = self.connect()
+        sock1.sendall(b'Action: QueueSummary\r\nQueue: 1\r\n'
+                      b'ActionID: same\r\n\r\n')
+        sock2.sendall(b'Action: QueueSummary\r\nQueue: 2\r\n'
+                      b'ActionID: same\r\n\r\n')
+        for fp, queue in ((fp1, '1'), (fp2, '2')):
+            self.assertEqual(self.read(fp)['ActionID'], 'same')
+            self.assertEqual(self.read(fp)['Queue'], queue)
+            self.assertEqual(self.read(fp)['Event'], 'QueueSummaryComplete')
+        upstream_ids = set(
+            i['ActionID'] for i in self.server.received
+            if i['Action'] == 'QueueSummary')
+        self.assertEqual(len(upstream_ids), 2)
+        self.assertNotIn('same', upstream_ids)
+        sock1.close()
+        sock2.close()
+
+    def test_event_filter(self):
+        sock1, fp1 = self.connect()
+        sock2, fp2 = self.connect(
+            b'Action: Filter\r\nOperation: Add\r\n'
+            b'Filter: Event: Hangup\r\n\r\n')
+        sock3, fp3 = self.connect(
+            b'Action: Events\r\nEventMask: off\r\n\r\n')
+        self.server.send_event(
+            b'Event: Newchannel\r\nChannel: SIP/1\r\n\r\n'
+            b'Event: Hangup\r\nChannel: SIP/1\r\n\r\n')
+        self.assertEqual(self.read(fp1)['Event'], 'Newchannel')
+        self.assertEqual(self.read(fp1)['Event'], 'Hangup')
+        self.assertEqual(self.read(fp2)['Event'], 'Hangup')
+        sock3.sendall(b'Action: Ping\r\n\r\n')
+        self.assertEqual(self.read(fp3)['Ping'], 'Pong')
+        for sock in (sock1, sock2, sock3):
+            sock.close()
+
+    def test_monami_events(self):
+        # The Events: mask and the POSIX Filter that SequentialAmi(events=)
+        # sends are honoured.
+        host, port = self.proxy.address()
+        ami = SequentialAmi(
+            host, port, username='wall', secret='board', events=['Hangup'],
+            disconnect_mode=SequentialAmi.DIS_NEVER)
+        received = []
+        ami.on_unexpected = received.append
+        sock, fp = self.connect(b'Action: Events\r\nEventMask: agent\r\n\r\n')
+        try:
+            deadline = time.time() + 5
+            while time.time() < deadline and not ami.is_authenticated():
+                ami.work(0.01)
+            ami.add_action('Ping', {})  # after the Filter
+            ami.next_action()
+            while time.time() < deadline and ami._actions:
+                ami.work(0.01)
+            self.server.send_event(
+                b'Event: Newchannel\r\nChannel: SIP/1\r\n\r\n'
+                b'Event: QueueCallerJoin\r\nQueue: 1\r\n\r\n'
+                b'Event: Hangup\r\nPrivilege: call,all\r\n\r\n')
+            while time.time() < deadline and not received:
+                ami.work(0.01)
+            self.assertEqual(self.read(fp)['Event'], 'QueueCallerJoin')
+        finally:
+            ami.close()
+            sock.close()
+        self.assertEqual([i['Event'] for i in received], ['Hangup'])
+
+    def test_command_output(self):
+        sock, fp = self.connect()
+        for output_headers in (False, True):
+            self.server.output_headers = output_headers
+            sock.sendall(b'Action: Command\r\nCommand: cmd\r\n\r\n')
+            lines = list(iter(fp.readline, b'\r\n'))
+            if output_headers:
+                self.assertEqual(lines[-3:], [
+                    b'Output: cmd output %d\r\n' % (i,) for i in range(3)])
+            else:
+                self.assertEqual(lines[-4:], [
+                    b'cmd output 0\n', b'cmd output 1\n', b'cmd output 2\n',
+                    b'--END COMMAND--\r\n'])
+        sock.close()
+
+    def test_client_reset(self):
+        sock1, fp1 = self.connect()
+        sock1.sendall(b'Action: QueueSummary\r\nQueue: 1\r\n\r\n')
+        sock1.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                         struct.pack('ii', 1, 0))
+        fp1.close()
+        sock1.close()  # RST instead of FIN
+        time.sleep(0.1)
+        self.assertTrue(self.thread.is_alive())
+        sock2, fp2 = self.connect()
+        sock2.sendall(b'Action: Ping\r\n\r\n')
+        self.assertEqual(self.read(fp2)['Ping'], 'Pong')
+        sock2.close()
+
+    def test_authentication(self):
+        sock = socket.create_connection(self.proxy.address(), timeout=5)
+        fp = sock.makefile('rb')
+        fp.readline()
+        sock.sendall(b'Action: Ping\r\n\r\n')
+        self.assertEqual(self.read(fp)['Response'], 'Error')
+        sock.sendall(
+            b'Action: Login\r\nUsername: wall\r\nSecret: bad\r\n\r\n')
+        self.assertEqual(self.read(fp)['Message'], 'Authentication failed')
+        self.assertEqual(fp.read(), b'')
+        sock.close()
+
+
+class EventFilterTestCase(unittest.TestCase):
+    def test_events_to_mask(self):
+        self.assertEqual(events_to_mask([]), 'off')
+        self.assertEqual(events_to_mask(['Hangup', 'Newchannel']), 'call')
+        self.assertEqual(
+            events_to_mask(['QueueCallerJoin', 'Hangup']), 'agent,call')
+        self.assertEqual(events_to_mask(['Hangup', 'SomethingNew']), 'on')
+
+    def test_login_filter(self):
+        server = FakeAmiServer()
+        try:
+            s = SequentialAmi(events=['Hangup', 'Newchannel'],
+                              **server.kwargs())
+            s.add_action('Ping', {})
+            s.process()
+        finally:
+            server.close()
+        login, filter, ping = server.received
+        self.assertEqual(login['Events'], 'call')
+        self.assertEqual(filter['Action'], 'Filter')
+        self.assertEqual(
+            filter['Filter'], 'Event: (Hangup|Newchannel)[[:space:]]')
+        self.assertEqual(ping['Action'], 'Ping')
+
+    def test_login_filter_refused(self):
+        # No write=system permissions: we get the whole category instead.
+        server = FakeAmiServer()
+        server.refuse = ('Filter',)
+        try:
+            s = SequentialAmi(events=['Join'], **server.kwargs())
+            s.add_action('Ping', {})
+            s.process()
+        finally:
+            server.close()
+        login, filter, ping = server.received
+        self.assertEqual(login['Events'], 'call')
+        self.assertEqual(filter['Action'], 'Filter')
+        self.assertEqual(ping['Action'], 'Ping')
+
+
+class BulkOriginateTestCase(unittest.TestCase):
+    def test_run(self):
+        server = FakeAmiServer()
+        results = []
+        specs = [{'Channel': channel, 'Exten': '200'} for channel in (
+            'SIP/one', 'SIP/busy', 'SIP/two', 'SIP/refused', 'SIP/three')]
+        try:
+            t0 = time.time()
+            summary = BulkOriginate(
+                server.kwargs(auth='plain'), calls_per_second=20,
+                max_channels=2).run(specs, results.append)
+            elapsed = time.time() - t0
+        finally:
+            server.close()
+
+        self.assertEqual(
+            [(r['spec']['Channel'], r['success'], r['reason'])
+             for r in results],
+            [('SIP/one', True, '4'), ('SIP/busy', False, '5'),
+             ('SIP/two', True, '4'), ('SIP/refused', False, 'Invalid channel'),
+             ('SIP/three', True, '4')])
+        self.assertEqual((summary['success'], summary['failure']), (3, 2))
+        # 5 calls at 20 cps with a bucket of 1: at least 4 intervals.
+        self.assertGreaterEqual(elapsed, 0.2)
+        originates = [i for i in server.received if i['Action'] == 'Originate']
+        self.assertEqual(len(originates), 5)
+        self.assertTrue(all(i['Async'] == 'true' for i in originates))
+
+    def test_missed_hangup(self):
+        server = FakeAmiServer()
+        results = []
+        bulk = BulkOriginate(server.kwargs(auth='plain'), max_channels=1)
+        bulk.max_channel_time = 0.1
+        try:
+            t0 = time.time()
+            summary = bulk.run(
+                [{'Channel': 'SIP/stuck'}, {'Channel': 'SIP/one'}],
+                results.append)
+            elapsed = time.time() - t0
+        finally:
+            server.close()
+        self.assertEqual(summary['success'], 2)
+        self.assertGreaterEqual(elapsed, 0.1)
+        self.assertLess(elapsed, 5)
+
+
+class RollingReloadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeAmiServer()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.bad_kwargs = {'host': '127.0.0.1',
+                           'port': sock.getsockname()[1]}
+        sock.close()  # nobody listening there now
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_rolling(self):
+        results, skipped = rolling_reload_asterisken(
+            [self.server.kwargs()] * 4 + [self.bad_kwargs], max_parallel=2)
+        self.assertEqual(skipped, [])
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len([r for r in results if r['error']]), 1)
+        self.assertEqual(
+            [step for step, seconds in results[0]['timings']],
+            ['connect', 'login', 'dialplan reload', 'module reload func_odbc',
+             'sip reload'])
+
+    def test_canary(self):
+        results, skipped = rolling_reload_asterisken(
+            [self.bad_kwargs] + [self.server.kwargs()] * 3, canary=1)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(len(skipped), 3)
+
+    def test_failure_rate(self):
+        results, skipped = rolling_reload_asterisken(
+            [self.bad_kwargs] * 2 + [self.server.kwargs()] * 3,
+            max_parallel=1, max_failure_rate=0.5)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(len(skipped), 4)
+
+
+class KeepaliveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeAmiServer()
+        self.ami = SequentialAmi(
+            keepalive=0.1, pong_timeout=0.2,
+            disconnect_mode=SequentialAmi.DIS_NEVER, **self.server.kwargs())
+
+    def tearDown(self):
+        self.ami.close()
+        self.server.close()
+
+    def work(self, seconds):
+        t0 = time.time()
+        while time.time() - t0 < seconds:
+            self.ami.work(0.01)
+
+    def pings(self):
+        return [i for i in self.server.received if i['Action'] == 'Ping']
+
+    def test_idle_pings(self):
+        self.work(0.5)
+        self.assertGreaterEqual(len(self.pings()), 2)
+        self.assertLessEqual(len(self.pings()), 5)
+
+    def test_no_ping_when_busy(self):
+        self.work(0.05)  # log in
+        self.server.delay = 0.01
+        t0 = time.time()
+        while time.time() - t0 < 0.5:
+            # Activity from the other end: no pings needed.
+            self.ami.add_action('Events', {'EventMask': 'off'})
+            self.ami.next_action()
+            self.ami.work(0.03)
+        self.assertEqual(self.pings(), [])
+
+    def test_pong_rtt_sample(self):
+        self.work(0.05)  # log in
+        self.ami.on_unexpected = lambda dict: None
+        rtt = self.ami._rtt
+        for other_data, samples in ((True, rtt.samples),
+                                    (False, rtt.samples + 1)):
+            self.ami._keepalive_ping()
+            if other_data:
+                # The pong got stuck behind an event.
+                self.ami.on_dict({'Event': 'Newchannel'})
+            self.ami.on_dict({'Response': 'Success', 'Ping': 'Pong',
+                              'ActionID': self.ami._ping_action_id})
+            self.assertEqual(rtt.samples, samples)
+
+    def test_pong_timeout(self):
+        self.server.ignore = ('Ping',)
+        self.assertRaises(MonAmiTimeout, self.work, 2)
+        self.assertEqual(len(self.pings()), 1)
+
+
+class RingBufferTestCase(unittest.TestCase):
+    def test_wrap(self):
+        buffer = RingBuffer(4)
+        self.assertEqual(
+            (len(buffer), buffer.latest(), buffer.rate()), (0, None, None))
+        for i in range(6):
+            buffer.append(100 + i, i * 10)
+        self.assertEqual(len(buffer), 4)
+        self.assertEqual(
+            buffer.samples(),
+            [(102, 20), (103, 30), (104, 40), (105, 50)])
+        self.assertEqual(buffer.latest(), 50)
+        self.assertEqual(buffer.samples(1), [(104, 40), (105, 50)])
+
+    def test_queries(self):
+        buffer = RingBuffer(100)
+        for i in range(11):
+            buffer.append(i, i * i)
+        self.assertEqual(buffer.delta(), 100)
+        self.assertEqual(buffer.rate(), 10)
+        self.assertEqual(buffer.rate(2), (100 - 64) / 2.0)
+        self.assertEqual(buffer.percentile(0), 0)
+        self.assertEqual(buffer.percentile(50), 25)
+        self.assertEqual(buffer.percentile(100), 100)
+        self.assertEqual(buffer.percentile(95), 90.5)
+
+
+class FleetPollerTestCase(unittest.TestCase):
+    def test_poll(self):
+        server = FakeAmiServer()
+        poller = FleetPoller([server.kwargs(auth='plain')], capacity=8)
+        for name in ('queuesummary', 'channels', 'sippeers'):
+            poller.add_query(name, 0.05)
+        thread = threading.Thread(target=poller.run)
+        thread.start()
+        try:
+            host = '127.0.0.1:%d' % (server.port,)
+            deadline = time.time() + 5
+            while time.time() < deadline and len(
+                    poller.buffer(host, 'sip_peers_ok') or ()) < 3:
+                thread.join(0.05)
+        finally:
+            poller.close()
+            thread.join()
+            server.close()
+
+        self.assertEqual(poller.buffer(host, 'channels').latest(), 3)
+        self.assertEqual(poller.buffer(host, 'channels').rate(), 0)
+        self.assertEqual(poller.buffer(host, 'sip_peers_ok').latest(), 2)
+        self.assertEqual(
+            poller.buffer(host, 'sip_peers_unreachable').latest(), 1)
+        self.assertEqual(poller.buffer(host, 'sip_peer_latency').latest(), 15)
+        self.assertEqual(
+            poller.buffer(host, 'callers', queue='22').latest(), 2)
+        # One login for all polls.
+        self.assertEqual(
+            [i['Action'] for i in server.received].count('login'), 1)
+
+    def test_failing_query(self):
+        class Poller(FleetPoller):
+            QUERIES = dict(FleetPoller.QUERIES, broken=(
+                'Fail', {}, None, lambda events: iter(())))
+
+        server = FakeAmiServer()
+        poller = Poller([server.kwargs(auth='plain')], capacity=8)
+        for name in ('queuesummary', 'broken'):
+            poller.add_query(name, 0.05)
+        thread = threading.Thread(target=poller.run)
+        thread.start()
+        try:
+            host = '127.0.0.1:%d' % (server.port,)
+            deadline = time.time() + 5
+            while time.time() < deadline and len(
+                    poller.buffer(host, 'callers', queue='22') or ()) < 3:
+                thread.join(0.05)
+        finally:
+            poller.close()
+            thread.join()
+            server.close()
+
+        # The failing query does not take the queuesummary down with it.
+        self.assertGreaterEqual(
+            len(poller.buffer(host, 'callers', queue='22')), 3)
+        self.assertGreaterEqual(
+            [i['Action'] for i in server.received].count('Fail'), 2)
+        self.assertEqual(
+            [i['Action'] for i in server.received].count('login'), 1)
+
+
+class CallbackExecutorTestCase(unittest.TestCase):
+    def test_order_and_slow(self):
+        slow = []
+        executor = CallbackExecutor(max_workers=4, slow_threshold=0.02)
+        executor.on_slow = lambda callback, seconds: slow.append(seconds)
+        calls = []
+
+        def callback(key, i):
+            time.sleep(0.03 if i == 0 else 0)
+            calls.append((key, i))
+
+        for i in range(20):
+            for key in ('a', 'b'):
+                executor.submit(key, callback, key, i)
+        self.assertTrue(executor.wait(5))
+        for key in ('a', 'b'):
+            self.assertEqual(
+                [i for k, i in calls if k == key], list(range(20)))
+        self.assertEqual(len(slow), 2)
+        executor.shutdown()
+
+    def test_queued_is_not_slow(self):
+        slow, errors = [], []
+        executor = CallbackExecutor(max_workers=1, slow_threshold=0.06)
+        executor.on_slow = lambda callback, seconds: slow.append(seconds)
+        executor.on_error = lambda callback, e: errors.append(e)
+
+        def callback(fail):
+            time.sleep(0.04)
+            if fail:
+                raise ValueError('fail')
+
+        # Waiting for the single worker does not count.
+        for key in ('a', 'b', 'c'):
+            executor.submit(key, callback, key == 'c')
+        self.assertTrue(executor.wait(5))
+        executor.shutdown()
+        self.assertEqual(slow, [])
+        self.assertEqual([str(e) for e in errors], ['fail'])
+
+    def test_multihost(self):
+        server = FakeAmiServer()
+        executor = CallbackExecutor()
+        results, threads = [], set()
+
+        def callback(dict, input):
+            threads.add(threading.current_thread())
+            time.sleep(0.01)
+            if dict.get('Event') == 'QueueSummary':
+                results.append(dict['Queue'])
+
+        s = MultiHostSequentialAmi(executor=executor)
+        for i in range(3):
+            s.add_action('QueueSummary', {'Queue': str(i)}, callback,
+                         'QueueSummaryComplete')
+        try:
+            s.add_connection(**server.kwargs())
+            s.add_connection(**server.kwargs())
+            self.assertEqual(s.process(), [])
+        finally:
+            server.close()
+            executor.shutdown()
+        self.assertEqual(sorted(results), ['0', '0', '1', '1', '2', '2'])
+        self.assertNotIn(threading.current_thread(), threads)
+
+
+class EventMergerTestCase(unittest.TestCase):
+    def test_merge(self):
+        merger = EventMerger(window=1.0)
+        merger.push('a', {'Event': 'A1', 'Timestamp': '10.0'}, received=100)
+        merger.push('a', {'Event': 'A2', 'Timestamp': '12.0'}, received=100.1)
+        merger.push('b', {'Event': 'B1', 'Timestamp': '11.0'}, received=100.5)
+        merger.push('c', {'Event': 'C1'}, received=9.5)  # no Timestamp
+        self.assertEqual(len(merger), 4)
+        # Only A1 and C1 have been held back for a second.
+        self.assertEqual(
+            [(host, dict['Event']) for when, host, received, dict
+             in merger.pop(now=101.05)],
+            [('c', 'C1'), ('a', 'A1')])
+        self.assertEqual(
+            [(when, host) for when, host, received, dict
+             in merger.pop(now=102)],
+            [(11.0, 'b'), (12.0, 'a')])
+        self.assertEqual(len(merger), 0)
+
+    def test_flush(self):
+        merger = EventMerger(window=60)
+        merger.push('a', {'Event': 'A1'})
+        self.assertEqual(list(merger.pop()), [])
+        self.assertEqual(len(list(merger.pop(flush=True))), 1)
+
+    def test_listen(self):
+        servers = [FakeAmiServer(), FakeAmiServer()]
+        events = []
+
+        def send_events():
+            deadline = time.time() + 5
+            while (time.time() < deadline and
+                   not all(len(i.conns) for i in servers)):
+                time.sleep(0.01)
+            time.sleep(0.1)
+            servers[1].send_event(
+                b'Event: Hangup\r\nTimestamp: 1000.2\r\n\r\n')
+            servers[0].send_event(
+                b'Event: Hangup\r\nTimestamp: 1000.1\r\n\r\n')
+            time.sleep(0.1)
+            for server in servers:
+                server.disconnect()
+                server.close()
+
+        thread = threading.Thread(target=send_events)
+        thread.start()
+        errors = listen_asterisken(
+            [server.kwargs(auth='plain') for server in servers],
+            lambda *event: events.append(event), window=5)
+        thread.join()
+        self.assertEqual(len(errors), 2)
+        self.assertEqual([event[0] for event in events], [1000.1, 1000.2])
+
+
+class SinkTestCase(unittest.TestCase):
+    def test_json_lines(self):
+        stream = io.BytesIO()
+        sink = JsonLinesSink(stream, flush_interval=60, report_interval=0)
+        sink.write('pbx1', 1000.1, 1000.2, {'Event': 'Hangup'})
+        sink.write('pbx2', 1000.3, 1000.4, {'Event': 'Newchannel'})
+        self.assertEqual(stream.getvalue(), b'')  # still buffered
+        sink.flush()
+        lines = [json.loads(i.decode('utf-8'))
+                 for i in stream.getvalue().splitlines()]
+        self.assertEqual(lines[0], {
+            'host': 'pbx1', 'time': 1000.1, 'received': 1000.2,
+            'event': {'Event': 'Hangup'}})
+        self.assertEqual(lines[1]['event']['Event'], 'Newchannel')
+        self.assertEqual(sink.events, 2)
+
+    def test_listen(self):
+        server = FakeAmiServer()
+        stream = io.BytesIO()
+        sink = JsonLinesSink(stream, flush_interval=60, report_interval=0)
+
+        def send_events():
+            deadline = time.time() + 5
+            while time.time() < deadline and not server.conns:
+                time.sleep(0.01)
+            time.sleep(0.1)
+            server.send_event(b'Event: Hangup\r\nTimestamp: 1000.1\r\n\r\n')
+            time.sleep(0.1)
+            server.disconnect()
+            server.close()
+
+        thread = threading.Thread(target=send_events)
+        thread.start()
+        listen_asterisken(
+            [server.kwargs(auth='plain')], sink.on_event, window=0)
+        thread.join()
+        sink.close()
+        line = json.loads(stream.getvalue().decode('utf-8'))
+        self.assertEqual((line['host'], line['time']), ('127.0.0.1', 1000.1))
+
+    def test_rotating_file(self):
+        tempdir = tempfile.mkdtemp()
+        path = os.path.join(tempdir, 'events')
+        sink = RotatingFileSink(
+            path, max_bytes=1, compress=True, flush_interval=60,
+            report_interval=0)
+        for i in range(3):
+            sink.write('pbx1', i, i, {'Event': 'Hangup'})
+            sink.flush()
+        sink.close()
+        filenames = sorted(os.listdir(tempdir))
+        self.assertEqual(len(filenames), 3)
+        self.assertTrue(all(i.endswith('.gz') for i in filenames))
+        events = []
+        for filename in filenames:
+            with gzip.open(os.path.join(tempdir, filename)) as fp:
+                events.extend(json.loads(i.decode('utf-8'))['time']
+                              for i in fp.read().splitlines())
+        self.assertEqual(sorted(events), [0, 1, 2])
+        for filename in filenames:
+            os.unlink(os.path.join(tempdir, filename))
+        os.rmdir(tempdir)
+
+    def test_datagram(self):
+        path = tempfile.mktemp()
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.bind(path)
+        receiver.settimeout(5)
+        try:
+            sink = DatagramSink(
+                path, max_datagram=200, flush_interval=60,
+                report_interval=0)
+            for i in range(5):
+                sink.write('pbx1', i, i, {'Event': 'Hangup'})
+            sink.close()
+            lines = []
+            while len(lines) < 5:
+                datagram = receiver.recv(65536)
+                self.assertTrue(len(datagram) <= 200)
+                lines.extend(datagram.splitlines())
+            self.assertEqual(
+                [json.loads(i.decode('utf-8'))['time'] for i in lines],
+                [0, 1, 2, 3, 4])
+            self.assertEqual(sink.dropped, 0)
+        finally:
+            receiver.close()
+            os.unlink(path)
+
+    def test_make_sink(self):
+        sink = make_sink('file:/tmp/x,max_bytes=100,gzip,flush=0.5')
+        sink.close()
+        self.assertTrue(isinstance(sink, RotatingFileSink))
+        self.assertEqual(
+            (sink.path, sink.max_bytes, sink.compress, sink.flush_interval),
+            ('/tmp/x', 100, True, 0.5))
+        self.assertRaises(ValueError, make_sink, 'file:')
+        self.assertRaises(ValueError, make_sink, 'unix:/tmp/x,gzip')
+        self.assertRaises(ValueError, make_sink, 'tcp:localhost')
+
+
+class QuorumTestCase(unittest.TestCase):
+    def test_quorum(self):
+        servers = [FakeAmiServer() for i in range(3)]
+        servers[2].ignore = ('QueueSummary',)  # sick host, never answers
+        try:
+            start = time.time()
+            ret = fetch_queuesummary(
+                [server.kwargs(auth='plain') for server in servers], '22',
+                min_hosts=2, tail_timeout=0.2)
+            self.assertTrue(time.time() - start < 3)
+            self.assertEqual(ret['queued_callers'], 4)
+            self.assertEqual(ret['missing'], ['127.0.0.1:%d' % (
+                servers[2].port,)])
+        finally:
+            for server in servers:
+                server.close()
+
+    def test_failed_hosts(self):
+        servers = [FakeAmiServer() for i in range(2)]
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        refused = {'host': '127.0.0.1', 'port': sock.getsockname()[1]}
+        sock.close()  # nobody listening there now
+        servers[1].refuse = ('QueueSummary',)
+        try:
+            ret = fetch_queuesummary(
+                [server.kwargs(auth='plain') for server in servers] +
+                [refused], '22', min_hosts=1)
+        finally:
+            for server in servers:
+                server.close()
+        self.assertEqual(ret['queued_callers'], 2)
+        self.assertEqual(sorted(ret['missing']), sorted(
+            '127.0.0.1:%d' % (i,) for i in (servers[1].port, refused['port'])))
+
+    def test_all_answered(self):
+        servers = [FakeAmiServer() for i in range(2)]
+        try:
+            s = MultiHostSequentialAmi(min_hosts=1, tail_timeout=5)
+            s.add_action('QueueSummary', {}, stop_event='QueueSummaryComplete')
+            for server in servers:
+                s.add_connection(**server.kwargs(auth='plain'))
+            start = time.time()
+            self.assertEqual(s.process(), [])
+            self.assertTrue(time.time() - start < 3)
+            self.assertEqual((len(s.completed), s.missing), (2, []))
+        finally:
+            for server in servers:
+                server.close()
+
+
+class RttEstimatorTestCase(unittest.TestCase):
+    def test_rto(self):
+        rtt = RttEstimator()
+        self.assertEqual(rtt.rto(), 1.0)
+        rtt.sample(0.1)
+        self.assertAlmostEqual(rtt.rto(), 0.3)  # 0.1 + 4 * 0.05
+        for i in range(50):
+            rtt.sample(0.01)
+        self.assertAlmostEqual(rtt.srtt, 0.01, places=3)
+        self.assertEqual(rtt.rto(), 0.2)  # min_rto
+        rtt.backoff()
+        rtt.backoff()
+        self.assertEqual(rtt.rto(), 0.8)
+        rtt.sample(0.01)
+        self.assertEqual(rtt.rto(), 0.2)
+
+    def test_samples_kept_per_host(self):
+        server = FakeAmiServer()
+        try:
+            s = SequentialAmi(**server.kwargs(auth='md5'))
+            s.add_action('Ping', {})
+            s.process()
+            # Connect, challenge and login.
+            self.assertEqual(
+                rtt_estimator('127.0.0.1', server.port).samples, 3)
+            self.assertTrue(s.timeout(1) < 2)
+        finally:
+            server.close()
+
+    def test_welcome_timeout(self):
+        class QuickAmi(SequentialAmi):
+            server_time = 0.1
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)  # accepted by the kernel, but no welcome message
+        try:
+            ami = QuickAmi(
+                host='127.0.0.1', port=sock.getsockname()[1],
+                disconnect_mode=SequentialAmi.DIS_NEVER)
+            start = time.time()
+            self.assertRaises(MonAmiError, ami.process)
+            self.assertTrue(time.time() - start < 1)
+            ami.close()
+        finally:
+            sock.close()
+
+
+class TransferTrackerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.done = []
+        self.tracker = TransferTracker(
+            max_age=60, on_transfer=lambda *args: self.done.append(args))
+
+    def feed(self, when, event, host='pbx1', **kwargs):
+        kwargs['Event'] = event
+        self.tracker.on_event(when, host, when, kwargs)
+
+    def test_blind(self):
+        self.feed(10, 'BlindTransfer', Result='Success',
+                  TransfereeUniqueid='a.1', TransfereeLinkedid='a.1')
+        # The transferee is dialed through a Local channel.
+        self.feed(11, 'DialBegin', Uniqueid='l.2', Linkedid='a.1',
+                  DestUniqueid='c.1')
+        self.feed(13, 'DialEnd', Uniqueid='l.2', Linkedid='a.1',
+                  DestUniqueid='c.1', DialStatus='ANSWER')
+        self.assertEqual(self.done, [('pbx1', 'blind', 'completed', 3)])
+        stats = self.tracker.stats()['blind']
+        self.assertEqual(
+            (stats['started'], stats['completed'], stats['pending'],
+             stats['latency_p50']), (1, 1, 0, 3))
+
+    def test_attended_and_blonde(self):
+        self.feed(10, 'DialBegin', Uniqueid='b.2', DestUniqueid='c.1')
+        self.feed(12, 'DialEnd', Uniqueid='b.2', DestUniqueid='c.1',
+                  DialStatus='ANSWER')
+        self.feed(20, 'AttendedTransfer', Result='Success',
+                  TransferTargetUniqueid='c.1')
+        self.feed(30, 'DialBegin', Uniqueid='b.4', DestUniqueid='d.1')
+        self.feed(32, 'AttendedTransfer', Result='Success',
+                  TransferTargetUniqueid='d.1')  # d is still ringing
+        self.feed(35, 'DialEnd', Uniqueid='b.4', DestUniqueid='d.1',
+                  DialStatus='ANSWER')
+        self.assertEqual(self.done, [
+            ('pbx1', 'attended', 'completed', 10),
+            ('pbx1', 'blonde', 'completed', 3)])
+
+    def test_pickup_failure_and_expiry(self):
+        self.feed(10, 'DialBegin', Uniqueid='a.1', DestUniqueid='b.1')
+        self.feed(14, 'Pickup', Uniqueid='c.1', TargetUniqueid='b.1')
+        self.feed(20, 'BlindTransfer', Result='Success',
+                  TransfereeUniqueid='e.1')
+        self.feed(21, 'Hangup', Uniqueid='e.1')
+        self.feed(30, 'DialEnd', Uniqueid='f.1', DestUniqueid='g.1',
+                  DialStatus='', Forward='SIP/h')
+        self.feed(100, 'Hangup', Uniqueid='x.1', host='pbx2')
+        self.assertEqual(self.done, [
+            ('pbx1', 'pickup', 'completed', 4),
+            ('pbx1', 'blind', 'failed', None),
+            ('pbx1', 'redirect', 'expired', None)])
+
+    def test_expiring_table(self):
+        table = ExpiringTable(10)
+        table.set('a', 1, now=0)
+        table.set('b', 2, now=5)
+        table.set('a', 3, now=6)  # refreshed
+        self.assertEqual(table.expire(12), [])
+        self.assertEqual(table.expire(15), [('b', 2)])
+        self.assertEqual((len(table), table.get('a')), (1, 3))
+
+
+def sip(start_line, call_id, cseq, from_tag='a', to_tag=None, headers=(),
+        body=''):
+    lines = [
+        start_line, 'Via: SIP/2.0/UDP 10.0.0.1:5060;branch=z9hG4bK1',
+        'From: <sip:alice@example.com>;tag=%s' % (from_tag,),
+        'To: <sip:bob@example.com>%s' % (
+            ';tag=%s' % (to_tag,) if to_tag else '',),
+        'Call-ID: %s' % (call_id,), 'CSeq: %s' % (cseq,)]
+    lines.extend(headers)
+    lines.append('Content-Length: %d' % (len(body),))
+    return '%s\r\n\r\n%s' % ('\r\n'.join(lines), body)
+
+
+class SipTraceTestCase(unittest.TestCase):
+    def classify(self, messages):
+        # Asterisk "sip set debug" style.
+        trace = ''.join(
+            '[Oct 19 10:00:00] VERBOSE[1] chan_sip.c: \n'
+            '<--- SIP read from UDP:10.0.0.1:5060 --->\n%s\n'
+            '<------------->\n' % (message,) for message in messages)
+        fd, filename = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(trace.encode('utf-8'))
+            transfers = []
+            classifier = classify_file(
+                filename, TransferClassifier(transfers.append))
+            classifier.flush()
+            return classifier, transfers
+        finally:
+            os.unlink(filename)
+
+    def test_iter_messages(self):
+        frag = 'SIP/2.0 200 OK\r\n'
+        buf = (sip('NOTIFY sip:b@x SIP/2.0', 'c1', '3 NOTIFY', headers=(
+            'Event: refer', 'Content-Type: message/sipfrag;version=2.0'),
+            body=frag) + sip('SIP/2.0 200 OK', 'c1', '3 NOTIFY', to_tag='b')
+        ).encode('ascii')
+        messages = list(iter_messages(buf))
+        # The sipfrag body is skipped, not parsed as a message.
+        self.assertEqual(
+            [(i['method'], i['status'], i['body']) for i in messages],
+            [('NOTIFY', None, frag.encode('ascii')), (None, 200, b'')])
+        self.assertEqual(messages[1]['headers']['cseq'], '3 NOTIFY')
+
+    def test_transfers(self):
+        invite = sip('INVITE sip:bob@x SIP/2.0', 'ab', '1 INVITE')
+        classifier, transfers = self.classify([
+            # 302, retransmitted after the call was dropped
+            sip('INVITE sip:bob@x SIP/2.0', 'r1', '1 INVITE'),
+            sip('SIP/2.0 302 Moved', 'r1', '1 INVITE', to_tag='b',
+                headers=('Contact: <sip:charlie@x>',)),
+            sip('SIP/2.0 302 Moved', 'r1', '1 INVITE', to_tag='b',
+                headers=('Contact: <sip:charlie@x>',)),
+            # Pickup of a ringing call
+            sip('INVITE sip:bob@x SIP/2.0', 'p1', '1 INVITE'),
+            sip('SIP/2.0 180 Ringing', 'p1', '1 INVITE', to_tag='b'),
+            sip('INVITE sip:alice@x SIP/2.0', 'p2', '1 INVITE',
+                from_tag='c', headers=(
+                    'Replaces: p1;to-tag=a;from-tag=b;early-only',)),
+            # Blind transfer, REFER retransmitted
+            invite,
+            sip('SIP/2.0 200 OK', 'ab', '1 INVITE', to_tag='b'),
+            sip('REFER sip:alice@x SIP/2.0', 'ab', '2 REFER', 'b', 'a',
+                headers=('Refer-To: <sip:charlie@x>',)),
+            sip('REFER sip:alice@x SIP/2.0', 'ab', '2 REFER', 'b', 'a',
+                headers=('Refer-To: <sip:charlie@x>',)),
+            sip('SIP/2.0 202 Accepted', 'ab', '2 REFER', 'b', 'a'),
+            sip('NOTIFY sip:bob@x SIP/2.0', 'ab', '3 NOTIFY', headers=(
+                'Event: refer',
+                'Content-Type: message/sipfrag;version=2.0'),
+                body='SIP/2.0 180 Ringing\r\n'),
+            # Attended transfer of a confirmed BC dialog
+            sip('INVITE sip:charlie@x SIP/2.0', 'bc', '1 INVITE', 'b'),
+            sip('SIP/2.0 200 OK', 'bc', '1 INVITE', 'b', 'c'),
+            sip('REFER sip:alice@x SIP/2.0', 'ab', '4 REFER', 'b', 'a',
+                headers=('Refer-To: <sip:charlie@x?Replaces=bc%3Bfrom-tag'
+                         '%3Db%3Bto-tag%3Dc>',)),
+            sip('INVITE sip:charlie@x SIP/2.0', 'ac', '1 INVITE', headers=(
+                'Replaces: bc;from-tag=b;to-tag=c',)),
+            # Blonde transfer: BD is still ringing
+            sip('INVITE sip:dave@x SIP/2.0', 'bd', '1 INVITE', 'b'),
+            sip('SIP/2.0 180 Ringing', 'bd', '1 INVITE', 'b', 'd'),
+            sip('REFER sip:alice@x SIP/2.0', 'ab', '5 REFER', 'b', 'a',
+                headers=('Refer-To: <sip:dave@x?Replaces=bd%3Bto-tag%3Dd'
+                         '%3Bfrom-tag%3Db>',)),
+        ])
+        self.assertEqual(
+            [(i['type'], i['call_id'], i['status']) for i in transfers],
+            [('302', 'r1', None), ('pickup', 'p2', None),
+             ('blind', 'ab', 180), ('attended', 'ab', None),
+             ('blonde', 'ab', None)])
+        self.assertEqual(transfers[0]['target'], '<sip:charlie@x>')
+        self.assertEqual(transfers[3]['completed_by'], 'ac')
+        self.assertEqual(classifier.counts['302'], 1)
+        self.assertEqual(classifier.counts['blind'], 1)
+
+    def test_failed_reinvite(self):
+        classifier, transfers = self.classify([
+            sip('INVITE sip:charlie@x SIP/2.0', 'bc', '1 INVITE', 'b'),
+            sip('SIP/2.0 200 OK', 'bc', '1 INVITE', 'b', 'c'),
+            # Hold re-INVITE glare
+            sip('INVITE sip:charlie@x SIP/2.0', 'bc', '2 INVITE', 'b', 'c'),
+            sip('SIP/2.0 491 Request Pending', 'bc', '2 INVITE', 'b', 'c'),
+            sip('INVITE sip:charlie@x SIP/2.0', 'ac', '1 INVITE', headers=(
+                'Replaces: bc;from-tag=b;to-tag=c',)),
+        ])
+        self.assertEqual([i['type'] for i in transfers], ['attended'])
+
+    def test_dialog_end(self):
+        # The REFER transfer is passed on when its dialog ends, and then
+        # the dialog is forgotten.
+        classifier, transfers = self.classify([
+            sip('INVITE sip:bob@x SIP/2.0', 'ab', '1 INVITE'),
+            sip('SIP/2.0 200 OK', 'ab', '1 INVITE', to_tag='b'),
+            sip('REFER sip:alice@x SIP/2.0', 'ab', '2 REFER', 'b', 'a',
+                headers=('Refer-To: <sip:charlie@x>',)),
+            sip('SIP/2.0 202 Accepted', 'ab', '2 REFER', 'b', 'a'),
+            sip('BYE sip:alice@x SIP/2.0', 'ab', '3 BYE', 'b', 'a'),
+            sip('SIP/2.0 200 OK', 'ab', '3 BYE', 'b', 'a'),
+        ])
+        self.assertEqual(
+            [(i['type'], i['status']) for i in transfers], [('blind', 202)])
+        self.assertEqual((classifier._calls, classifier._seen), ({}, {}))
+
+
+class QueueStatsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'queuestats')
+
+    def tearDown(self):
+        for filename in os.listdir(self.tempdir):
+            os.unlink(os.path.join(self.tempdir, filename))
+        os.rmdir(self.tempdir)
+
+    def test_publish_and_read(self):
+        writer = QueueStatsWriter(self.path, 3)
+        reader = QueueStatsReader(self.path)
+        self.assertEqual(reader.read(), (0.0, {}))
+        writer.publish({'22': {'queued_callers': 4, 'calls': 2},
+                        'sales': {'abandoned': 1}}, now=1000.5)
+        updated, stats = reader.read()
+        self.assertEqual(updated, 1000.5)
+        self.assertEqual(sorted(stats), ['22', 'sales'])
+        self.assertEqual(
+            (stats['22']['queued_callers'], stats['22']['calls'],
+             stats['22']['holdtime'], stats['22']['updated']),
+            (4, 2, 0, 1000.5))
+        self.assertRaises(ValueError, writer.publish, dict(
+            (str(i), {}) for i in range(4)))
+        writer.close()
+        reader.close()
+
+    def test_seqlock(self):
+        writer = QueueStatsWriter(self.path, 1)
+        reader = QueueStatsReader(self.path)
+        reader.max_retries = 20
+        writer._set_sequence(writer._sequence + 1)  # writing, forever
+        self.assertRaises(ValueError, reader.read)
+        writer._set_sequence(writer._sequence + 1)
+        self.assertEqual(reader.read()[1], {})
+        writer.close()
+        reader.close()
+
+    def test_relayout(self):
+        writer = QueueStatsWriter(self.path, 1)
+        reader = QueueStatsReader(self.path)
+        writer.publish({'22': {'calls': 1}})
+        writer.close()
+        writer = QueueStatsWriter(self.path, 2)  # different size
+        writer.publish({'22': {'calls': 2}, '23': {'calls': 3}})
+        self.assertEqual(
+            sorted((k, v['calls']) for k, v in reader.read()[1].items()),
+            [('22', 2), ('23', 3)])
+        writer.close()
+        reader.close()
+
+    def test_publisher(self):
+        servers = [FakeAmiServer(), FakeAmiServer()]
+        try:
+            publisher = QueueStatsPublisher(
+                [server.kwargs() for server in servers], ['22', '23'],
+                self.path)
+            self.assertEqual(publisher.poll(), [])
+            publisher.close()
+            publisher.run()  # closes the sessions
+            stats = QueueStatsReader(self.path).get('23')
+            self.assertEqual(
+                (stats['queued_callers'], stats['calls'],
+                 stats['completed']), (4, 4, 10))
+            # One fleet query per action, not per queue.
+            self.assertEqual(
+                [i['Action'] for i in servers[0].received
+                 if i['Action'].startswith('Queue')],
+                ['QueueSummary', 'QueueStatus'])
+        finally:
+            for server in servers:
+                server.close()
+
+    def test_publisher_stuck_host(self):
+        servers = [FakeAmiServer(), FakeAmiServer()]
+        servers[1].ignore = ('QueueSummary', 'QueueStatus')
+        try:
+            publisher = QueueStatsPublisher(
+                [server.kwargs() for server in servers],
+                [str(i) for i in range(20)], self.path)
+            publisher._daemon.query_timeout = 0.5
+            t0 = time.time()
+            errors = publisher.poll()
+            elapsed = time.time() - t0
+            publisher.close()
+            publisher.run()
+        finally:
+            for server in servers:
+                server.close()
+        # A single deadline for all queues.
+        self.assertLess(elapsed, 1.5)
+        self.assertEqual(
+            [host for host, error in errors],
+            ['127.0.0.1:%d' % (servers[1].port,)])